@@ -0,0 +1,112 @@
+import sqlite3
+import json
+import time
+import os
+import threading
+
+# default location of the on disk cache shared by the annotation sources
+CACHE_FILE = 'cache/annotation-cache.sqlite'
+
+# sqlite limits how many variables a query can have
+MAX_QUERY_VARIABLES = 500
+
+DAY = 24 * 60 * 60
+
+# seconds to wait for another process writing to the cache
+LOCK_TIMEOUT = 60
+
+
+# Key/value store kept in a sqlite table. Values are stored as json with an
+# expiry time, and the least recently used entries are removed once the table
+# holds more than max_entries.
+class AnnotationCache:
+    def __init__(self, table, file_name=CACHE_FILE, ttl=30*DAY,
+                 max_entries=200000):
+        self.table = table
+        self.file_name = file_name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # make cache dir if it doesn't exist
+        directory = os.path.dirname(file_name)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+        # the cache may be shared by worker threads, and by the processes of
+        # a sharded run, which wait for each other's writes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, timeout=LOCK_TIMEOUT,
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'create table if not exists "{}" (key text primary key, '
+                'value text, expires real, used real)'.format(table))
+            self.connection.execute(
+                'create index if not exists "{0}_used" on "{0}" (used)'.format(
+                    table))
+
+    # Returns a dictionary with the values found for keys, expired entries
+    # count as missing
+    def get_many(self, keys):
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        with self.lock, self.connection:
+            for i in range(0, len(keys), MAX_QUERY_VARIABLES):
+                sub_keys = keys[i:(i+MAX_QUERY_VARIABLES)]
+                rows = self.connection.execute(
+                    'select key, value from "{}" where expires > ? and key in '
+                    '({})'.format(self.table, ', '.join('?' for k in sub_keys)),
+                    [now] + sub_keys).fetchall()
+                for key, value in rows:
+                    found[key] = json.loads(value)
+                self.connection.executemany(
+                    'update "{}" set used = ? where key = ?'.format(self.table),
+                    [(now, key) for key, value in rows])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    # Store a dictionary of values, ttl defaults to the cache's ttl
+    def put_many(self, items, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        now = time.time()
+        rows = [(key, json.dumps(value), now + ttl, now)
+                for key, value in items.items()]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'replace into "{}" (key, value, expires, used) values '
+                '(?, ?, ?, ?)'.format(self.table), rows)
+
+    def put(self, key, value, ttl=None):
+        self.put_many({key: value}, ttl)
+
+    # Remove expired entries, then the least recently used ones past the limit
+    def evict(self):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'delete from "{}" where expires <= ?'.format(self.table),
+                [time.time()])
+            if self.max_entries is not None:
+                self.connection.execute(
+                    'delete from "{0}" where key in (select key from "{0}" '
+                    'order by used desc limit -1 offset ?)'.format(self.table),
+                    [self.max_entries])
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                'select count(*) from "{}"'.format(self.table)).fetchone()[0]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self)}
+
+    def close(self):
+        self.evict()
+        self.connection.close()
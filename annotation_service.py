@@ -0,0 +1,338 @@
+import driver
+import microbes_online as mo
+import conserved_domains as cdd
+from annotation_cache import AnnotationCache, CACHE_FILE, DAY
+from compact_frames import as_strings, compact
+from run_metrics import metrics
+import pandas as pd
+import argparse
+import functools
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+# how long conserved domain search results are kept, searches are slow so the
+# service remembers them like it does microbes online results
+SEARCH_TTL = 30*DAY
+
+# seconds a request waits for the batches it is in before it gives up
+REQUEST_TIMEOUT = 600
+
+
+# Runs function on batches of items gathered from many callers. Items asked
+# for within max_wait seconds of each other go in the same batch, up to
+# max_batch items, and up to workers batches run at once. function takes a
+# list of unique items and returns a dict of their results.
+class Coalescer:
+    def __init__(self, function, max_batch=250, max_wait=0.05, workers=1):
+        self.function = function
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.condition = threading.Condition()
+        # (items, future) of each request waiting for a batch
+        self.pending = []
+        self.requests = 0
+        self.batches = 0
+        self.items = 0
+        thread = threading.Thread(target=self.gather, daemon=True)
+        thread.start()
+
+    # Results for items, waiting for the batches they end up in. Raises
+    # TimeoutError if they take more than timeout seconds.
+    def lookup(self, items, timeout=None):
+        items = list(dict.fromkeys(items))
+        futures = []
+        with self.condition:
+            for i in range(0, len(items), self.max_batch):
+                future = Future()
+                self.pending.append((items[i:(i+self.max_batch)], future))
+                futures.append(future)
+            self.requests += 1
+            self.condition.notify()
+        results = {}
+        for future in futures:
+            results.update(future.result(timeout))
+        return results
+
+    def gather(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+                # give other requests a moment to join the batch
+                deadline = time.time() + self.max_wait
+                while sum(len(i) for i, f in self.pending) < self.max_batch \
+                        and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                batch = [self.pending.pop(0)]
+                size = len(batch[0][0])
+                while len(self.pending) > 0 and \
+                        size + len(self.pending[0][0]) <= self.max_batch:
+                    size += len(self.pending[0][0])
+                    batch.append(self.pending.pop(0))
+                self.batches += 1
+                self.items += size
+            self.executor.submit(self.run_batch, batch)
+
+    def run_batch(self, batch):
+        items = list(dict.fromkeys(i for request, f in batch for i in request))
+        try:
+            results = self.function(items)
+        except Exception as e:
+            for request, future in batch:
+                future.set_exception(e)
+            return
+        for request, future in batch:
+            future.set_result({i: results.get(i, []) for i in request})
+
+    def stats(self):
+        with self.condition:
+            return {'requests': self.requests, 'batches': self.batches,
+                    'items': self.items, 'waiting': len(self.pending)}
+
+
+# Keeps what a run of driver.py sets up, microbes online connections, the
+# caches and the connections to NCBI, open between requests, and batches the
+# genes and GIs of requests that come in together into shared queries.
+class AnnotationService:
+    def __init__(self, query_mode='joined', workers=2, backend='mysql',
+                 mirror_file=mo.MIRROR_FILE, cache_file=CACHE_FILE,
+                 max_batch=250, max_wait=0.05, max_concurrent=4,
+                 timeout=REQUEST_TIMEOUT, gene_batch=None, fetch_size=10000):
+        self.query_mode = query_mode
+        self.fetch_size = fetch_size
+        self.timeout = timeout
+        connect = mo.get_mysql_connection
+        if backend == 'local':
+            if query_mode == 'streaming':
+                raise ValueError('query mode streaming needs the mysql '
+                                 'backend')
+            connect = functools.partial(mo.get_mirror_connection, mirror_file)
+        self.pool = mo.ConnectionPool(workers, connect)
+        self.gene_cache = AnnotationCache('microbes_online', cache_file)
+        self.search_cache = AnnotationCache('cdd_searches', cache_file,
+                                            ttl=SEARCH_TTL)
+        self.description_cache = cdd.get_cdd_description_cache(cache_file)
+        # streaming mode can take larger batches of genes than of searches
+        if gene_batch is None:
+            gene_batch = max_batch
+        self.genes = Coalescer(self.lookup_genes, gene_batch, max_wait,
+                               workers)
+        self.searches = Coalescer(self.lookup_gis, max_batch, max_wait,
+                                  max_concurrent)
+        self.started = time.time()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    # microbes online rows of each gene, from the cache or one query
+    def lookup_genes(self, genes):
+        results = self.gene_cache.get_many(genes)
+        missing = [g for g in genes if g not in results]
+        if len(missing) > 0:
+            raw_dfs = []
+            batch_time = mo.run_gene_batch(self.pool, missing, raw_dfs.append,
+                                           self.query_mode, self.fetch_size)
+            found = {g: [] for g in missing}
+            for raw_df in raw_dfs:
+                found.update(mo.rows_by_gene(raw_df, missing))
+            self.gene_cache.put_many(found)
+            results.update(found)
+            metrics.observe('service.gene_batch_seconds', batch_time)
+        return results
+
+    # conserved domain hits of each GI, from the cache or one search
+    def lookup_gis(self, gis):
+        results = self.search_cache.get_many(gis)
+        missing = [gi for gi in gis if gi not in results]
+        if len(missing) == 0:
+            return results
+        for sub_gis, query_results in cdd.query_ncbi_cdd_batches([missing],
+                                                                 1):
+            # failed searches are not remembered
+            if query_results is None:
+                continue
+            found = {str(gi): [] for gi in sub_gis}
+            df_acc_id = as_strings(cdd.get_accession_information(
+                query_results))
+            df_acc_id = df_acc_id.astype(object).where(df_acc_id.notnull(),
+                                                       None)
+            for row in df_acc_id.to_dict('records'):
+                found.setdefault(row['gi'], []).append(row)
+            self.search_cache.put_many(found)
+            results.update(found)
+        return results
+
+    # The annotation of genes as driver.py would write it
+    def annotate(self, genes, fields=driver.OUTPUT_FIELDS, formula=True):
+        with self.lock:
+            self.requests += 1
+        start_time = time.time()
+        gene_rows = self.genes.lookup(genes, self.timeout)
+        mo_df = frame([row for g in genes for row in gene_rows.get(g, [])],
+                      ['name', 'gi'])
+        mo_df = driver.create_interpro_link(mo.filter_output(mo_df, fields),
+                                            formula)
+
+        gis = [gi for gi in mo_df['gi'].dropna().astype(str).unique()]
+        gi_rows = self.searches.lookup(gis, self.timeout)
+        cdd_df = frame([row for gi in gis for row in gi_rows.get(gi, [])],
+                       ['gi', 'accession', 'cdd_name'])
+        cdd_df = cdd.filter_output(cdd_df, fields)
+
+        accessions = list(cdd_df['accession'].dropna().unique())
+        desct_df = pd.DataFrame(columns=['accession', 'cdd_description'])
+        if len(accessions) > 0:
+            desct_df = cdd.get_cdd_descriptions(
+                accessions, cache=self.description_cache)
+
+        df = driver.join_annotations(mo_df, cdd_df, desct_df)
+        df = driver.reshape_data(df).reindex(columns=fields)
+        metrics.observe('service.request_seconds', time.time() - start_time)
+        return df
+
+    def stats(self):
+        with self.lock:
+            requests = self.requests
+        return {'uptime_seconds': round(time.time() - self.started, 1),
+                'requests': requests,
+                'gene_batches': self.genes.stats(),
+                'search_batches': self.searches.stats(),
+                'microbes_online_cache': self.gene_cache.stats(),
+                'search_cache': self.search_cache.stats(),
+                'description_cache': self.description_cache.stats(),
+                'ncbi_requests': cdd.ncbi_scheduler.stats(),
+                'metrics': metrics.report()}
+
+    def close(self):
+        self.pool.close()
+        self.gene_cache.close()
+        self.search_cache.close()
+        self.description_cache.close()
+
+
+# Data frame of records like a BatchCollector's result, with columns when
+# there are no records
+def frame(records, columns):
+    if len(records) == 0:
+        return pd.DataFrame(columns=columns)
+    return compact(as_strings(pd.DataFrame(records)))
+
+
+# GET /annotate?genes=a,b,c or POST /annotate with a json body
+# {"genes": [...]} or one gene per line, returns json records or csv with
+# format=csv. GET /status returns the service's counters.
+class AnnotationHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        if parts.path == '/status':
+            self.send_json(self.server.service.stats())
+        elif parts.path == '/annotate':
+            genes = [g for value in query.get('genes', [])
+                     for g in value.split(',')]
+            self.respond(genes, query.get('format', ['json'])[0])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path != '/annotate':
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(parts.query)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        output_format = query.get('format', ['json'])[0]
+        try:
+            request = json.loads(body)
+            genes = request['genes']
+            output_format = request.get('format', output_format)
+        except (ValueError, KeyError, TypeError):
+            genes = body.split('\n')
+        self.respond(genes, output_format)
+
+    def respond(self, genes, output_format):
+        genes = [g.strip() for g in genes if g.strip() != '']
+        if len(genes) == 0:
+            self.send_json({'error': 'no genes given'}, 400)
+            return
+        try:
+            df = self.server.service.annotate(genes)
+        except TimeoutError:
+            self.send_json({'error': 'timed out waiting for the lookups'},
+                           504)
+            return
+        except Exception as e:
+            self.send_json({'error': str(e)}, 500)
+            return
+        if output_format == 'csv':
+            self.send_body(df.to_csv(index=False), 'text/csv')
+        else:
+            df = df.astype(object).where(df.notnull(), '')
+            self.send_json({'genes': len(genes),
+                            'rows': df.to_dict('records')})
+
+    def send_json(self, value, status=200):
+        self.send_body(json.dumps(value, default=str), 'application/json',
+                       status)
+
+    def send_body(self, text, content_type, status=200):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(service, host='127.0.0.1', port=8080):
+    server = http.server.ThreadingHTTPServer((host, port), AnnotationHandler)
+    server.daemon_threads = True
+    server.service = service
+    print('Annotation service listening on http://{}:{}'.format(
+          host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Annotate genes over http, keeping connections and '
+                    'caches open between requests.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--query-mode', default='joined',
+                        choices=['joined', 'narrow', 'streaming'])
+    parser.add_argument('--workers', type=int, default=2,
+                        help='microbes online connections')
+    parser.add_argument('--backend', default='mysql',
+                        choices=['mysql', 'local'])
+    parser.add_argument('--mirror-file', default=mo.MIRROR_FILE)
+    parser.add_argument('--batch-size', type=int, default=250,
+                        help='most genes looked up in one microbes online '
+                             'query')
+    parser.add_argument('--fetch-size', type=int, default=10000,
+                        help='rows streaming mode reads at a time')
+    parser.add_argument('--max-wait', type=float, default=0.05,
+                        help='seconds to wait for other requests to share a '
+                             'batch with')
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT,
+                        help='seconds a request waits for its lookups')
+    args = parser.parse_args()
+    service = AnnotationService(args.query_mode, args.workers, args.backend,
+                                args.mirror_file, max_wait=args.max_wait,
+                                timeout=args.timeout,
+                                gene_batch=args.batch_size,
+                                fetch_size=args.fetch_size)
+    serve(service, args.host, args.port)
@@ -0,0 +1,459 @@
+import driver
+import microbes_online as mo
+import conserved_domains as cdd
+from run_metrics import peak_memory_mb
+import numpy as np
+import argparse
+import contextlib
+import datetime as dt
+import http.server
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+
+# Runs every stage of the pipeline on synthetic genes without microbes online
+# or NCBI: a fake mysql connection answers query.txt with rows shaped like the
+# real ones, and a local http server stands in for the bwrpsb searches and the
+# conserved domain pages. Times are appended to RESULTS_FILE so runs can be
+# compared over time.
+
+RESULTS_FILE = 'benchmark-results.jsonl'
+SIZES = [1000, 10000, 100000]
+
+# columns of query.txt, in order
+QUERY_FIELDS = ['name', 'locus_id', 'organism', 'gene_name',
+                'gene_description', 'cog_info_id', 'cog_description',
+                'fun_code', 'fun_code_description', 'fun_code_group',
+                'tigr_description', 'go_id', 'go_name', 'go_type',
+                'go_evidence', 'ipr_id', 'ipr_name', 'synonym',
+                'synonym_description']
+
+# the first three are needed by postprocess_query_result
+SYNONYM_TYPES = ['GI', 'NCBI accession number', 'NCBI GeneID', 'Locus tag',
+                 'Gene name', 'Alternative locus tag']
+
+# sizes of the vocabularies values are picked from, repeated values are
+# shared between genes like in the real data
+NUM_ORGANISMS = 50
+NUM_COGS = 4000
+NUM_TIGR = 300
+NUM_GO_TERMS = 5000
+NUM_IPR = 3000
+NUM_DOMAINS = 2000
+
+
+def gene_name(number):
+    return 'GENE{:06d}'.format(number)
+
+
+def gene_number(name):
+    return int(name[4:])
+
+
+def make_genes(num_genes):
+    return [gene_name(g) for g in range(num_genes)]
+
+
+def vocabulary(template, size):
+    return np.array([template.format(i) for i in range(size)], dtype=object)
+
+
+# Every combination of go_terms go rows, interpro ipr rows and synonyms
+# synonym rows for each gene, like the joined query returns, as a list of
+# row tuples and the field names. Values only depend on the gene names, so a
+# gene gets the same rows in every batch.
+def make_query_result(genes, go_terms=3, interpro=2, synonyms=4):
+    synonyms = max(3, min(synonyms, len(SYNONYM_TYPES)))
+    numbers = np.array([gene_number(g) for g in genes], dtype=np.int64)
+    per_gene = go_terms*interpro*synonyms
+    gene_index = np.repeat(np.arange(len(genes)), per_gene)
+    within = np.tile(np.arange(per_gene), len(genes))
+    locus = numbers[gene_index]
+    go = (locus*7 + within//(interpro*synonyms)*13) % NUM_GO_TERMS
+    ipr = (locus*5 + (within//synonyms) % interpro*17) % NUM_IPR
+    synonym = within % synonyms
+
+    cog = locus % NUM_COGS
+    # some loci have no cog or tigr role
+    has_cog = locus % 7 != 0
+    has_tigr = locus % 3 != 0
+    fun_codes = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'), dtype=object)
+    synonym_values = np.array(
+        [[str(1000000 + n), 'NP_{:06d}.1'.format(n), str(5000000 + n),
+          'LT_{}'.format(n), 'gn{}'.format(n), 'ALT_{}'.format(n)]
+         for n in numbers], dtype=object)
+
+    columns = {
+        'name': np.array(genes, dtype=object)[gene_index],
+        'locus_id': (100000 + locus).astype(str).astype(object),
+        'organism': vocabulary('Organism {}', NUM_ORGANISMS)[
+            locus % NUM_ORGANISMS],
+        'gene_name': synonym_values[gene_index, 4],
+        'gene_description': vocabulary('predicted protein {}', 1000)[
+            locus % 1000],
+        'cog_info_id': np.where(has_cog, cog.astype(str), None),
+        'cog_description': np.where(
+            has_cog, vocabulary('COG description {}', NUM_COGS)[cog], None),
+        'fun_code': np.where(has_cog, fun_codes[cog % 26], None),
+        'fun_code_description': np.where(
+            has_cog, vocabulary('function {}', 26)[cog % 26], None),
+        'fun_code_group': np.where(
+            has_cog, vocabulary('function group {}', 4)[cog % 4], None),
+        'tigr_description': np.where(
+            has_tigr, vocabulary('TIGR role {}', NUM_TIGR)[locus % NUM_TIGR],
+            None),
+        'go_id': vocabulary('GO:{:07d}', NUM_GO_TERMS)[go],
+        'go_name': vocabulary('go term {}', NUM_GO_TERMS)[go],
+        'go_type': np.array(['biological_process', 'molecular_function',
+                             'cellular_component'], dtype=object)[go % 3],
+        'go_evidence': np.array(['IEA', 'ISS'], dtype=object)[go % 2],
+        'ipr_id': vocabulary('IPR{:06d}', NUM_IPR)[ipr],
+        'ipr_name': vocabulary('interpro {}', NUM_IPR)[ipr],
+        'synonym': synonym_values[gene_index, synonym],
+        'synonym_description': np.array(SYNONYM_TYPES, dtype=object)[synonym]}
+    rows = list(zip(*[columns[f].tolist() for f in QUERY_FIELDS]))
+    return rows, list(QUERY_FIELDS)
+
+
+# Stands in for a mysql connector connection to microbes online. Select
+# queries are answered with make_query_result for the genes pasted into the
+# query, passed as parameters or loaded into the query_genes temporary
+# table, so the joined and streaming query modes work. latency seconds are
+# waited before each result, like a round trip to the server.
+class FakeMicrobesOnline:
+    def __init__(self, latency=0, **shape):
+        self.latency = latency
+        self.shape = shape
+        self.temp_genes = []
+
+    def cursor(self, buffered=True):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rows = []
+        self.position = 0
+
+    def execute(self, query, params=()):
+        if not query.lstrip().lower().startswith('select'):
+            # creating and clearing the temporary table
+            return
+        if 'from query_genes' in query:
+            genes = self.connection.temp_genes
+        elif len(params) > 0:
+            genes = list(params)
+        else:
+            genes = re.findall(r"'([^']*)'", query.split(' in (')[-1])
+        genes = sorted(set(g for g in genes if re.match(r'GENE\d+$', g)))
+        time.sleep(self.connection.latency)
+        self.rows, field_names = make_query_result(genes,
+                                                   **self.connection.shape)
+        self.description = [(f,) for f in field_names]
+        self.position = 0
+
+    def executemany(self, query, rows):
+        self.connection.temp_genes = [row[0] for row in rows]
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+    def fetchmany(self, size):
+        rows = self.rows[self.position:(self.position+size)]
+        self.position += len(rows)
+        return rows
+
+    def close(self):
+        pass
+
+
+# Use connections made by connect for the mysql backend of microbes_online
+# while in the with block
+@contextlib.contextmanager
+def fake_microbes_online(connect):
+    real_connect = mo.get_mysql_connection
+    mo.get_mysql_connection = connect
+    try:
+        yield
+    finally:
+        mo.get_mysql_connection = real_connect
+
+
+def accession(number):
+    if number % 2 == 0:
+        return 'cd{:05d}'.format(number)
+    return 'pfam{:05d}'.format(number)
+
+
+# The conserved domains of a GI, one to three of them
+def gi_domains(gi):
+    gi = int(gi)
+    return [(gi*11 + d*37) % NUM_DOMAINS for d in range(1 + gi % 3)]
+
+
+# Answers the requests conserved_domains sends to NCBI: bwrpsb submissions
+# get a search id, checks of a search return hits for its GIs once the
+# server's search_seconds have passed, and /Structure/cdd/ pages have a
+# description for the accession
+class NcbiStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        if parts.path.endswith('bwrpsb.cgi') and 'queries' in query:
+            body = self.submit(query['queries'][0].split('\n'))
+        elif parts.path.endswith('bwrpsb.cgi') and 'cdsid' in query:
+            body = self.check(query['cdsid'][0])
+        elif parts.path.startswith('/Structure/cdd/'):
+            body = self.description(parts.path.split('/')[-1])
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def submit(self, gis):
+        with self.server.lock:
+            query_id = 'QM3-qcdsearch-{}'.format(len(self.server.searches))
+            self.server.searches[query_id] = (time.time(), gis)
+        return '#Batch CD-search tool\tNIH/NLM/NCBI\n#cdsid\t{}\n'\
+               '#datatype\thits Results\n#status\t3\tRunning\n'.format(
+                   query_id)
+
+    def check(self, query_id):
+        with self.server.lock:
+            submitted, gis = self.server.searches[query_id]
+        if time.time() - submitted < self.server.search_seconds:
+            return '#cdsid\t{}\n#status\t3\tRunning\n'.format(query_id)
+        lines = ['Query\tHit type\tPSSM-ID\tFrom\tTo\tE-Value\tBitscore\t'
+                 'Accession\tShort name\tIncomplete\tSuperfamily']
+        for i, gi in enumerate(gis):
+            for domain in gi_domains(gi):
+                lines.append('Q#{} - {}\tSpecific\t{}\t1\t100\t{:.2e}\t50.5\t'
+                             '{}\tdomain_{}\t-\tcl00001'.format(
+                                 i + 1, gi, 200000 + domain,
+                                 1e-10*(1 + domain % 9), accession(domain),
+                                 domain))
+        return '#cdsid\t{}\n#status\t0\tsuccess\n\n{}\n'.format(
+            query_id, '\n'.join(lines))
+
+    def description(self, cdd_accession):
+        return '<html><body><div id="dscpt"><span>{0}</span><span>' \
+               'Conserved domain {0}, found in synthetic proteins.</span>' \
+               '</div></body></html>'.format(cdd_accession)
+
+
+# Start the stand-in for NCBI on a free local port, searches finish
+# search_seconds after they are submitted
+def start_ncbi_stub(search_seconds=0):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             NcbiStubHandler)
+    server.daemon_threads = True
+    server.searches = {}
+    server.search_seconds = search_seconds
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# cddid index of the synthetic domains leaving out every unindexed_every'th
+# one, so those have to be fetched from the stand-in's pages
+def make_cdd_index(index_file, unindexed_every=10):
+    connection = sqlite3.connect(index_file)
+    connection.execute('create table cddid (pssm_id text, accession text '
+                       'primary key, short_name text, description text, '
+                       'pssm_length text)')
+    connection.executemany(
+        'insert into cddid values (?, ?, ?, ?, ?)',
+        [(str(200000 + d), accession(d), 'domain_{}'.format(d),
+          'Conserved domain {}, found in synthetic proteins.'.format(
+              accession(d)), '100')
+         for d in range(NUM_DOMAINS) if d % unindexed_every != 0])
+    connection.commit()
+    connection.close()
+
+
+# Run each stage of the pipeline for num_genes genes, returns seconds per
+# stage and the sizes of what they made
+def benchmark_size(num_genes, shape, options):
+    genes = make_genes(num_genes)
+    result = {'genes': num_genes, 'seconds': {}, 'rows': {}}
+
+    def timed_stage(name, function, *args, **kwargs):
+        start_time = time.time()
+        value = function(*args, **kwargs)
+        result['seconds'][name] = round(time.time() - start_time, 4)
+        print('{} genes\t{}\t{:.4f} sec'.format(num_genes, name,
+                                                result['seconds'][name]))
+        return value
+
+    # post-processing alone, on the rows the database would return
+    batches = [genes[i:(i+options.batch_size)]
+               for i in range(0, len(genes), options.batch_size)]
+    query_results = [make_query_result(batch, **shape) for batch in batches]
+    result['rows']['query_result'] = sum(len(rows) for rows, f in
+                                         query_results)
+    timed_stage('postprocess_query_result',
+                lambda: [mo.postprocess_query_result(rows, field_names)
+                         for rows, field_names in query_results])
+    del query_results
+
+    # the whole microbes online stage against the fake database
+    with open('genes.txt', 'w') as f:
+        f.write('\n'.join(genes) + '\n')
+    connect = lambda: FakeMicrobesOnline(options.db_latency, **shape)
+    with fake_microbes_online(connect):
+        mo_df = timed_stage('microbes_online', mo.get_microbes_online_df,
+                            'genes.txt', options.fields,
+                            run_by_batch=options.batch_size, cache_file=None,
+                            query_mode=options.query_mode,
+                            workers=options.workers)
+    result['rows']['microbes_online'] = len(mo_df)
+    mo_df = timed_stage('interpro_links', driver.create_interpro_link, mo_df)
+
+    cdd_df = timed_stage('conserved_domains', cdd.get_cdd_information_from_gi,
+                         mo_df['gi'], options.fields,
+                         max_concurrent=options.ncbi_concurrent)
+    result['rows']['conserved_domains'] = len(cdd_df)
+    desct_df = timed_stage('cdd_descriptions', cdd.get_cdd_descriptions,
+                           cdd_df['accession'], cache_file=None,
+                           index_file=options.index_file)
+
+    df = timed_stage('merge', driver.join_annotations, mo_df, cdd_df,
+                     desct_df)
+    result['rows']['merge'] = len(df)
+    df = timed_stage('reshape_data', driver.reshape_data, df)
+    result['rows']['reshape_data'] = len(df)
+    timed_stage('write_csv', lambda: df.reindex(columns=options.fields).to_csv(
+        'output.csv', index=False))
+    result['total_seconds'] = round(sum(result['seconds'].values()), 4)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def last_result(results_file):
+    if not os.path.exists(results_file):
+        return None
+    last = None
+    with open(results_file) as f:
+        for line in f:
+            if line.strip() != '':
+                last = json.loads(line)
+    return last
+
+
+# Print each stage's time next to the one from the previous saved run
+def compare(run, previous):
+    old_sizes = {r['genes']: r for r in previous['results']}
+    print('\nCompared with the run of {} ({})'.format(previous['date'],
+                                                     previous['commit']))
+    print('genes\tstage\tbefore\tnow\tratio')
+    for result in run['results']:
+        old = old_sizes.get(result['genes'])
+        if old is None:
+            continue
+        for stage, seconds in result['seconds'].items():
+            before = old['seconds'].get(stage)
+            if before is None:
+                continue
+            print('{}\t{}\t{:.4f}\t{:.4f}\t{:.2f}'.format(
+                result['genes'], stage, before, seconds,
+                seconds/before if before > 0 else float('nan')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time each stage of the pipeline on synthetic genes with '
+                    'stand-ins for microbes online and NCBI.')
+    parser.add_argument('sizes', nargs='*', type=int, default=SIZES,
+                        help='numbers of genes to run, default {}'.format(
+                            ' '.join(str(s) for s in SIZES)))
+    parser.add_argument('--go-terms', type=int, default=3,
+                        help='go rows per locus')
+    parser.add_argument('--interpro', type=int, default=2,
+                        help='interpro rows per locus')
+    parser.add_argument('--synonyms', type=int, default=4,
+                        help='synonym rows per locus, 3 to {}'.format(
+                            len(SYNONYM_TYPES)))
+    parser.add_argument('--batch-size', type=int, default=250)
+    parser.add_argument('--query-mode', default='joined',
+                        choices=['joined', 'streaming'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--db-latency', type=float, default=0,
+                        help='seconds the fake database takes per query')
+    parser.add_argument('--search-seconds', type=float, default=0,
+                        help='seconds the stand-in takes per cdd search')
+    parser.add_argument('--ncbi-concurrent', type=int, default=50,
+                        help='cdd searches to run at once')
+    parser.add_argument('--results', default=RESULTS_FILE,
+                        help='file the results are appended to')
+    options = parser.parse_args()
+    options.results = os.path.abspath(options.results)
+    shape = {'go_terms': options.go_terms, 'interpro': options.interpro,
+             'synonyms': options.synonyms}
+
+    # the query is read before moving to the scratch directory
+    mo.read_query()
+    server = start_ncbi_stub(options.search_seconds)
+    cdd.set_ncbi_url('http://127.0.0.1:{}'.format(server.server_port),
+                     rate=10000)
+    run = {'date': dt.datetime.now().isoformat(), 'commit': git_commit(),
+           'shape': shape, 'options': {k: v for k, v in vars(options).items()
+                                       if k not in ['sizes', 'results']},
+           'results': []}
+    original_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            options.index_file = os.path.join(directory, 'cddid.sqlite')
+            make_cdd_index(options.index_file)
+            options.fields = driver.OUTPUT_FIELDS
+            for num_genes in options.sizes:
+                run['results'].append(benchmark_size(num_genes, shape,
+                                                     options))
+        finally:
+            os.chdir(original_directory)
+    server.shutdown()
+    run['peak_memory_mb'] = peak_memory_mb()
+
+    print('\ngenes\t' + '\t'.join(run['results'][0]['seconds']) + '\ttotal')
+    for result in run['results']:
+        print('{}\t{}\t{:.4f}'.format(
+            result['genes'],
+            '\t'.join('{:.4f}'.format(s) for s in result['seconds'].values()),
+            result['total_seconds']))
+
+    previous = last_result(options.results)
+    if previous is not None:
+        compare(run, previous)
+    with open(options.results, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    print('Results appended to {}'.format(options.results))
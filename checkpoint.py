@@ -0,0 +1,87 @@
+from compact_frames import read_batch, write_batch
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+# where the results of finished batches are kept between runs
+RUN_DIRECTORY = 'tmp/runs'
+
+
+# Stable name for a run from its input, like the list of genes
+def input_hash(inputs):
+    text = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+# Keeps the results of each finished batch of a run on disk along with a
+# manifest of which genes or GIs they cover, so a run that stopped part way
+# can be started again with resume=True and only query what is missing.
+# Runs are told apart by a hash of their input. A run that finishes removes
+# its batches with remove.
+class RunCheckpoint:
+    def __init__(self, inputs, resume=False, directory=RUN_DIRECTORY):
+        self.run_id = input_hash(inputs)
+        self.directory = os.path.join(directory, 'run-' + self.run_id)
+        self.manifest_file = os.path.join(self.directory, 'manifest.json')
+        # batches may finish on different threads
+        self.lock = threading.Lock()
+
+        if resume and os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+            print('Resuming run {} from {}'.format(self.run_id,
+                                                   self.directory))
+        else:
+            # start over, dropping results of an earlier run of this input
+            if os.path.exists(self.directory):
+                shutil.rmtree(self.directory)
+            self.manifest = {'run_id': self.run_id, 'stages': {}}
+        os.makedirs(self.directory, exist_ok=True)
+
+    # Drop the run's batches once they aren't needed to resume it
+    def remove(self):
+        with self.lock:
+            if os.path.exists(self.directory):
+                shutil.rmtree(self.directory)
+
+    # the genes or GIs of stage that already have results
+    def done_items(self, stage):
+        with self.lock:
+            batches = self.manifest['stages'].get(stage, [])
+            return set(item for batch in batches for item in batch['items'])
+
+    # files of the finished batches of stage that found something
+    def batch_files(self, stage):
+        with self.lock:
+            batches = list(self.manifest['stages'].get(stage, []))
+        return [os.path.join(self.directory, batch['file'])
+                for batch in batches if batch['file'] is not None]
+
+    # data frames of the finished batches of stage
+    def load(self, stage):
+        return [read_batch(f) for f in self.batch_files(stage)]
+
+    # Keep df as the result for the genes or GIs in items, df can be None if
+    # the batch finished without finding anything. Returns the file df was
+    # written to.
+    def save(self, stage, items, df):
+        with self.lock:
+            batches = self.manifest['stages'].setdefault(stage, [])
+            file_name = None
+            if df is not None and len(df.columns) > 0:
+                file_name = '{}-{:05d}.pkl'.format(stage, len(batches))
+                write_batch(df, os.path.join(self.directory, file_name))
+            batches.append({'items': [str(x) for x in items],
+                            'file': file_name})
+
+            # replace the manifest in one step so a crash can't leave half
+            # of it written
+            temp_file = self.manifest_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(self.manifest, f)
+            os.replace(temp_file, self.manifest_file)
+        if file_name is None:
+            return None
+        return os.path.join(self.directory, file_name)
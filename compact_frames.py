@@ -0,0 +1,183 @@
+import pandas as pd
+import os
+import tempfile
+import threading
+from pandas.api.types import CategoricalDtype, is_object_dtype, is_string_dtype
+
+# batches held in memory by a BatchCollector before they are written to disk
+SPILL_LIMIT_MB = 1024
+SPILL_DIRECTORY = 'tmp/spill'
+
+# text columns with at most this share of distinct values are stored as
+# categories, each distinct string is then kept once with a small integer
+# code per row
+MAX_UNIQUE_RATIO = 0.5
+
+
+def is_category(values):
+    return isinstance(values.dtype, CategoricalDtype)
+
+
+def is_text(values):
+    return not is_category(values) and (is_object_dtype(values) or
+                                        is_string_dtype(values))
+
+
+# Store the repetitive text columns of df, like organism, go_type or
+# cog_description, as categories. Changes df in place and returns it.
+def compact(df, max_unique_ratio=MAX_UNIQUE_RATIO):
+    for column in df.columns:
+        values = df[column]
+        if len(values) == 0 or not is_text(values):
+            continue
+        if values.nunique() <= max_unique_ratio*len(values):
+            df[column] = values.astype('category')
+    return df
+
+
+# pd.concat turns categorical columns whose categories differ between frames
+# back into objects, so the categories are made the same first
+def concat_frames(dfs, **kwargs):
+    dfs = list(dfs)
+    columns = set(c for df in dfs for c in df.columns
+                  if is_category(df[c]))
+    for column in columns:
+        categories = pd.Index([])
+        for df in dfs:
+            if column not in df.columns:
+                continue
+            if is_category(df[column]):
+                categories = categories.union(df[column].cat.categories)
+            else:
+                categories = categories.union(df[column].dropna().unique())
+        dtype = CategoricalDtype(categories)
+        dfs = [df.assign(**{column: df[column].astype(dtype)})
+               if column in df.columns else df for df in dfs]
+    return pd.concat(dfs, **kwargs)
+
+
+# fillna for frames with categorical columns, value is added to their
+# categories first
+def fill_blanks(df, value=''):
+    df = df.copy()
+    for column in df.columns:
+        values = df[column]
+        if is_category(values) and \
+                value not in values.cat.categories:
+            df[column] = values.cat.add_categories([value])
+    return df.fillna(value=value)
+
+
+# Memory used by df in MB, in total and by column
+def memory_report(df):
+    usage = df.memory_usage(deep=True, index=True)
+    return {'rows': len(df),
+            'total_mb': round(usage.sum()/2**20, 2),
+            'columns_mb': {str(c): round(usage[c]/2**20, 2)
+                           for c in usage.index},
+            'categorical': [str(c) for c in df.columns
+                            if is_category(df[c])]}
+
+
+# Strings for every value that isn't missing, like reading back a csv file
+# with dtype=str, where empty strings are missing too. Categorical columns
+# only have their categories converted.
+def as_strings(df):
+    df = df.copy()
+    for column in df.columns:
+        values = df[column]
+        if is_category(values):
+            categories = values.cat.categories.astype(str)
+            if categories.is_unique:
+                values = values.cat.rename_categories(categories)
+                if '' in categories:
+                    values = values.cat.remove_categories([''])
+                df[column] = values
+                continue
+            values = values.astype(object)
+        strings = values.astype(object).where(values.isnull(),
+                                              values.astype(str))
+        df[column] = strings.where(strings != '')
+    return df
+
+
+# Batches are pickled when spilled, which keeps their dtypes and is much
+# faster to write and read than csv. Checkpoints of older runs are csv.
+def write_batch(df, file_name):
+    df.to_pickle(file_name)
+
+
+def read_batch(file_name):
+    if file_name.endswith('.csv'):
+        return pd.read_csv(file_name, dtype=str)
+    return pd.read_pickle(file_name)
+
+
+# Collects the data frames of a stage's batches in memory. Once they take
+# more than limit_mb, the frames held in memory are written to pickle files
+# in directory and only read back by result(). Batches that are already on
+# disk, like the ones saved by a RunCheckpoint, are added with their file and
+# are dropped from memory instead of being written again.
+class BatchCollector:
+    def __init__(self, limit_mb=SPILL_LIMIT_MB, directory=SPILL_DIRECTORY):
+        self.limit = limit_mb*2**20
+        self.directory = directory
+        # [data frame or None, file or None] for each batch in order
+        self.batches = []
+        self.memory = 0
+        self.spill_files = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.batches)
+
+    # Add df, file_name is where it is already saved if it is
+    def add(self, df, file_name=None):
+        with self.lock:
+            self.batches.append([df, file_name])
+            self.memory += df.memory_usage(deep=True).sum()
+            if self.memory > self.limit:
+                self.spill()
+
+    # Add a batch that is on disk, it is read when result() is called
+    def add_file(self, file_name):
+        with self.lock:
+            self.batches.append([None, file_name])
+
+    def spill(self):
+        os.makedirs(self.directory, exist_ok=True)
+        num_written = 0
+        for batch in self.batches:
+            df, file_name = batch
+            if df is None:
+                continue
+            if file_name is None:
+                handle, file_name = tempfile.mkstemp(suffix='.pkl',
+                                                     dir=self.directory)
+                os.close(handle)
+                write_batch(df, file_name)
+                self.spill_files.append(file_name)
+                num_written += 1
+            batch[0] = None
+            batch[1] = file_name
+        print('Batches over {:.0f} MB, {} written to disk'.format(
+              self.memory/2**20, num_written))
+        self.memory = 0
+
+    # All of the batches as one data frame with string values and repeated
+    # text as categories, None if no batch was added
+    def result(self):
+        with self.lock:
+            batches = self.batches
+            self.batches = []
+            self.memory = 0
+        if len(batches) == 0:
+            return None
+        dfs = [df if df is not None else read_batch(file_name)
+               for df, file_name in batches]
+        df = compact(as_strings(concat_frames(dfs, ignore_index=True,
+                                              sort=False)))
+        for file_name in self.spill_files:
+            os.remove(file_name)
+        self.spill_files = []
+        return df
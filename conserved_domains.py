@@ -1,27 +1,59 @@
 import pandas as pd
 import time
+import random
+import queue
+import urllib.parse
 import urllib.request
 from bs4 import BeautifulSoup
 import sys
 import re  # regular expression package
-from datetime import datetime as dt
 import os
-from multiprocessing import Pool
+import sqlite3
+import csv
+import argparse
+import bisect
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from annotation_cache import AnnotationCache, CACHE_FILE, DAY
+from run_metrics import metrics, timed
+from compact_frames import BatchCollector, SPILL_LIMIT_MB
+from ncbi_http import HttpClient, RequestScheduler, POLL, DESCRIPTION, SUBMIT
 if sys.version_info[0] < 3:
     from StringIO import StringIO
 else:
     from io import StringIO
 
-
-# get accession numbers and more for conserved domains from NCBI CDD
-def get_cdd_information_from_gi(gi_list, filters=[], run_by_batch=250):
-    # make temporary file to hold sub runs
-    temp_file_name = 'tmp/tmp-cdd-information-{}.csv'.format(dt.now())
-    # make tmp dir if it doesn't exist
-    try:
-        os.makedirs("tmp/")
-    except FileExistsError:
-        pass
+# all searches, polls and description pages go through one client so
+# connections to ncbi are reused and requests share one rate limit, point it
+# at another server with set_ncbi_url
+NCBI_URL = 'https://www.ncbi.nlm.nih.gov'
+ncbi_scheduler = RequestScheduler()
+ncbi_client = HttpClient(NCBI_URL, scheduler=ncbi_scheduler)
+
+# threads downloading description pages, see get_description_executor
+description_executors = {}
+description_lock = threading.Lock()
+
+# descriptions of every conserved domain from NCBI
+CDDID_URL = 'https://ftp.ncbi.nih.gov/pub/mmdb/cdd/cddid.tbl.gz'
+CDD_INDEX_FILE = 'cache/cddid.sqlite'
+
+# how long downloaded cdd descriptions are kept in the cache
+DESCRIPTION_TTL = 90*DAY
+MISSING_DESCRIPTION_TTL = 1*DAY
+DESCRIPTION_CACHE_SIZE = 100000
+
+
+# get accession numbers and more for conserved domains from NCBI CDD,
+# max_concurrent batches are searched by NCBI at the same time. With a
+# checkpoint, GIs searched in an earlier run are not searched again. Results
+# are kept in memory until they take more than spill_mb, then written to
+# disk, except for the ones the checkpoint has already saved.
+def get_cdd_information_from_gi(gi_list, filters=[], run_by_batch=250,
+                                max_concurrent=4, checkpoint=None,
+                                spill_mb=SPILL_LIMIT_MB):
+    results = BatchCollector(spill_mb)
     # if not a list, typecast single one to list
     if isinstance(gi_list, int) or isinstance(gi_list, str):
         gi_list = [gi_list]
@@ -30,105 +62,301 @@ def get_cdd_information_from_gi(gi_list, filters=[], run_by_batch=250):
         gi_list = list(gi_list)
 
 
-    # find unique values
-    gi_list = list(set(gi_list))
-
-    # Check if results have been returned or if None returned every time
-    results_returned = False
-    # get information in chunks
-    for i in range(0, len(gi_list), run_by_batch):
-        sub_gis = []
-        # make sure genes gets correct indicies
-        if i + run_by_batch < len(gi_list):
-            sub_gis = gi_list[i:(i+run_by_batch)]
-        else:
-            sub_gis = gi_list[i:]
-
-        print("\n* Conserved_domains now processing {}-{} GIs of {}".format(
-              i+1, (i+len(sub_gis)), len(gi_list)))
-
-        query_results = query_ncbi_cdd(sub_gis)
+    # find unique values, sorted so a rerun makes the same batches
+    gi_list = sorted(set(gi_list), key=str)
+
+    # reuse searches that finished before the run stopped, they are only
+    # read from disk at the end
+    if checkpoint is not None:
+        done_gis = checkpoint.done_items('cdd')
+        gi_list = [gi for gi in gi_list if str(gi) not in done_gis]
+        for file_name in checkpoint.batch_files('cdd'):
+            results.add_file(file_name)
+        print("Conserved domains checkpoint: {} GIs already done".format(
+              len(done_gis)))
+
+    # split into chunks
+    batches = [gi_list[i:(i+run_by_batch)]
+               for i in range(0, len(gi_list), run_by_batch)]
+    print("\n* Conserved_domains now processing {} GIs in {} batches".format(
+          len(gi_list), len(batches)))
+
+    num_done = 0
+    for sub_gis, query_results in query_ncbi_cdd_batches(batches,
+                                                         max_concurrent):
+        num_done += len(sub_gis)
+        print("* Conserved_domains finished {} of {} GIs".format(
+              num_done, len(gi_list)))
 
         # check if something was returned, if not return None
         if query_results is not None:
-            query_results = add_gi_to_ncbi_query_results(query_results)
-
-            # accession id portion
-            df_acc_id = query_results[['gi', 'Accession', 'Short name',  'E-Value']]
-            df_acc_id = df_acc_id.rename(index=str, columns={'Short name': 'cdd_name',
-                                                             'Accession': 'accession'})  # , inplace=True)
-            # print(df_acc_id)
-
-            # write to temporary csv file
-            with open(temp_file_name, 'a') as f:
-                if not results_returned:
-                    df_acc_id.to_csv(f, index=False)
-                else:
-                    df_acc_id.to_csv(f, index=False, header=False)
-            results_returned = True
-
-    # TODO: Change to file checking and returning empty df
-    if not results_returned:
+            df_acc_id = get_accession_information(query_results)
+            file_name = None
+            if checkpoint is not None:
+                file_name = checkpoint.save('cdd', sub_gis, df_acc_id)
+            results.add(df_acc_id, file_name)
+
+    print('NCBI CDD searches: {}'.format(search_stats.summary()))
+    print('NCBI requests: {}'.format(ncbi_scheduler.summary()))
+
+    # TODO: Change to returning empty df
+    final_df = results.result()
+    if final_df is None:
         print('Conserved domains found no information for list of GIs')
         return None
 
-    # read in final df and return it
-    final_df = pd.read_csv(temp_file_name, dtype=str)
     # filter output if user gave filters
     if len(filters) > 0:
         final_df = filter_output(final_df, filters)
     return final_df
 
 
+# accession id portion of ncbi cdd query results
+def get_accession_information(query_results):
+    query_results = add_gi_to_ncbi_query_results(query_results)
+    df_acc_id = query_results[['gi', 'Accession', 'Short name',  'E-Value']]
+    df_acc_id = df_acc_id.rename(index=str, columns={'Short name': 'cdd_name',
+                                                     'Accession': 'accession'})
+    return df_acc_id
+
+
 # Returns the resulting file from ncbi cdd query
 # TODO: Return error if gi_list is longer than 4000
+@timed('ncbi.query_ncbi_cdd')
 def query_ncbi_cdd(gi_list):
     # if not a list, typecast single one to list
     if not isinstance(gi_list, list):
         gi_list = [gi_list]
 
+    # a search that times out is split, so there may be several results
+    results = [df for sub_gis, df in query_ncbi_cdd_batches([gi_list], 1)
+               if df is not None]
+    if len(results) == 0:
+        return(None)
+    return pd.concat(results, ignore_index=True)
+
+
+# Search NCBI CDD for several lists of GIs at once. Up to max_concurrent
+# searches are submitted and a new one is submitted as each finishes. Each
+# search is first checked around the time similar searches have taken to
+# finish, then at intervals growing by backoff (with some jitter) up to
+# max_interval. A search that doesn't return in time is split in half and
+# both halves are submitted again. Yields (gi_list, df) in the order the
+# searches finish, df is None if a search failed or a single GI timed out.
+# batches can also be a queue.Queue of gi lists ending with None, so more
+# batches can be added while the first ones are searched.
+def query_ncbi_cdd_batches(batches, max_concurrent=4, min_interval=1,
+                           max_interval=30, backoff=1.5, jitter=0.2,
+                           stats=None):
+    if stats is None:
+        stats = search_stats
+    if not isinstance(batches, queue.Queue):
+        batch_list = batches
+        batches = queue.Queue()
+        for gi_list in batch_list:
+            batches.put(gi_list)
+        batches.put(None)
+    more_batches = True
+    # split searches go ahead of new batches
+    waiting = []
+    # batches taken from the queue while waiting to check searches
+    arrived = []
+    # search id -> gi list, when to check it next and when to give up on it
+    running = {}
+    while more_batches or len(waiting) > 0 or len(running) > 0:
+        # keep max_concurrent searches going
+        while len(running) < max_concurrent:
+            if len(waiting) > 0:
+                gi_list = waiting.pop(0)
+            elif len(arrived) > 0:
+                gi_list = arrived.pop(0)
+            elif more_batches:
+                # only wait for a new batch if there is nothing to check
+                try:
+                    gi_list = batches.get(block=len(running) == 0)
+                except queue.Empty:
+                    break
+                if gi_list is None:
+                    more_batches = False
+                    break
+            else:
+                break
+            query_id = submit_ncbi_cdd(gi_list)
+            if query_id is None:
+                yield gi_list, None
+                continue
+            # amount of time to wait before moving on
+            max_wait_time = 20 + 2*len(gi_list)
+            # first check a little before the search is expected to finish
+            first_check = max(min_interval,
+                              0.75*stats.expected_latency(len(gi_list)))
+            now = time.time()
+            running[query_id] = {'gi_list': gi_list, 'start': now,
+                                 'deadline': now + max_wait_time,
+                                 'interval': min_interval, 'polls': 0,
+                                 'next_check': now + first_check}
+
+        if len(running) == 0:
+            continue
+
+        # wait for the next search that is due to be checked, a batch that
+        # comes in meanwhile is submitted right away if there is room
+        next_check = min(s['next_check'] for s in running.values())
+        if more_batches and len(running) < max_concurrent:
+            try:
+                gi_list = batches.get(timeout=max(0,
+                                                  next_check - time.time()))
+            except queue.Empty:
+                pass
+            else:
+                if gi_list is None:
+                    more_batches = False
+                else:
+                    arrived.append(gi_list)
+                continue
+        else:
+            time.sleep(max(0, next_check - time.time()))
+        for query_id in list(running):
+            search = running[query_id]
+            if search['next_check'] > time.time():
+                continue
+            gi_list = search['gi_list']
+            search['polls'] += 1
+            cdd_results = check_ncbi_cdd(query_id, gi_list)
+            wait_time = time.time() - search['start']
+            if cdd_results is not None:
+                del running[query_id]
+                stats.record(len(gi_list), search['polls'], wait_time)
+                print('NCBI query of {} returned in {:.0f} seconds'.format(
+                      len(gi_list), wait_time))
+                yield gi_list, read_ncbi_cdd_results(cdd_results)
+            elif time.time() > search['deadline']:
+                # the job didn't finish in time, try again in smaller pieces
+                del running[query_id]
+                stats.record(len(gi_list), search['polls'], wait_time,
+                             timed_out=True)
+                if len(gi_list) > 1:
+                    half = len(gi_list) // 2
+                    print("Query of {} GIs did not return after {:.0f} "\
+                          "seconds. Splitting it in two.".format(
+                              len(gi_list), wait_time))
+                    waiting[0:0] = [gi_list[:half], gi_list[half:]]
+                else:
+                    print("For GI {}, query did not return after {:.0f} "\
+                          "seconds. Aborting.".format(gi_list, wait_time))
+                    yield gi_list, None
+            else:
+                # check again later, backing off each time
+                interval = min(max_interval, search['interval']*backoff)
+                search['interval'] = interval
+                search['next_check'] = time.time() + interval*random.uniform(
+                    1 - jitter, 1 + jitter)
+
+
+# Poll counts and latencies of cdd searches, used to estimate when a new
+# search will be done and to tune the polling. Only the last history finished
+# searches are kept for the estimate, the counts and the latency histogram are
+# running totals so a long running process doesn't keep every search.
+class CddSearchStats:
+    def __init__(self, history=50, bins=[5, 10, 20, 40, 80, 160]):
+        self.recent = collections.deque(maxlen=history)
+        self.bins = bins
+        self.finished_by_bin = [0 for b in bins] + [0]
+        self.searches = 0
+        self.timed_out = 0
+        self.polls = 0
+        self.max_polls = 0
+        # searches may be run from several threads, like in the service
+        self.lock = threading.Lock()
+
+    def record(self, num_gis, polls, latency, timed_out=False):
+        with self.lock:
+            self.searches += 1
+            self.polls += polls
+            self.max_polls = max(self.max_polls, polls)
+            if timed_out:
+                self.timed_out += 1
+                return
+            self.recent.append(latency/num_gis)
+            self.finished_by_bin[bisect.bisect_right(self.bins, latency)] += 1
+
+    # expected seconds for a search of num_gis, from the median seconds per
+    # GI of recent searches that finished
+    def expected_latency(self, num_gis):
+        with self.lock:
+            rates = sorted(self.recent)
+        if len(rates) == 0:
+            return 0
+        return rates[len(rates)//2] * num_gis
+
+    # number of searches that finished within each bin of seconds, searches
+    # that timed out are counted on their own
+    def latency_histogram(self):
+        with self.lock:
+            histogram = {}
+            lower = 0
+            for upper, count in zip(self.bins + [float('inf')],
+                                    self.finished_by_bin):
+                histogram['{}-{}'.format(lower, upper)] = count
+                lower = upper
+            histogram['timed out'] = self.timed_out
+            return histogram
+
+    def summary(self):
+        histogram = self.latency_histogram()
+        with self.lock:
+            return {'searches': self.searches, 'timed_out': self.timed_out,
+                    'polls': self.polls, 'max_polls': self.max_polls,
+                    'latency_histogram': histogram}
+
+
+# stats for all searches run by this process
+search_stats = CddSearchStats()
+
+
+# Submit a search for gi_list and return the id to check it with, None if the
+# search couldn't be submitted
+@timed('ncbi.submit')
+def submit_ncbi_cdd(gi_list):
     # gi is joined string
     gi = '%0A'.join([str(x) for x in gi_list])
 
-    # amount of time to wait before moving on
-    max_wait_time = 20 + 2*len(gi_list)
-
     # get the id to search if query has finished yet
-    url = "https://www.ncbi.nlm.nih.gov/Structure/bwrpsb/bwrpsb.cgi?queries="\
-          + gi + "&useid1=true&tdata=hits"
-    success = False
+    url = "/Structure/bwrpsb/bwrpsb.cgi?queries=" + gi + "&useid1=true&tdata=hits"
     try:
-        contents = urllib.request.urlopen(url).read().decode("utf-8")
-
-        # get the query id from it's location on the content returned
-        query_id = contents.split('cdsid\t')[1].split('\n')[0]
-        # print('\nquery_id', query_id)
-        url_for_checking = 'https://www.ncbi.nlm.nih.gov/Structure/bwrpsb/bwrpsb'\
-                           '.cgi?cdsid=' + query_id
-        # check the url eveery 2 seconds until there is a success
-        for t in range(int(max_wait_time/2)):
-            time.sleep(2)
-            cdd_results = urllib.request.urlopen(url_for_checking).read().decode('utf-8')
-            if 'success' in cdd_results:
-                success = True
-                print('NCBI query of {} returned in {} seconds'.format(len(gi_list),
-                                                                        t*2))
-                break
+        contents = ncbi_client.get(url, SUBMIT).decode("utf-8")
     # if the web page doesn't work, report what value for
     except urllib.error.URLError:
         print("URLError when downloading query for GI: {}".format(gi))
         return(None)
 
-    # the job didn't finish in time, print ouput
-    if success == False:
-        print("For GI {}, query did not return after{} seconds. Aborting."\
-              "".format(max_wait_time, gi_list))
-        # return empty list so not a nontype
+    if 'cdsid\t' not in contents:
+        print("No search id returned for GI: {}".format(gi))
         return(None)
 
-    # make pandas table from the resulting string
-    df = pd.read_csv(StringIO(cdd_results.split("\n\n")[1]), sep="\t")
+    # get the query id from it's location on the content returned
+    query_id = contents.split('cdsid\t')[1].split('\n')[0]
+    return query_id
+
+
+# Return the search results if the search has finished, otherwise None
+@timed('ncbi.poll')
+def check_ncbi_cdd(query_id, gi_list=[]):
+    url_for_checking = '/Structure/bwrpsb/bwrpsb.cgi?cdsid=' + query_id
+    try:
+        cdd_results = ncbi_client.get(url_for_checking, POLL).decode('utf-8')
+    except urllib.error.URLError:
+        print("URLError when checking query for GI: {}".format(gi_list))
+        return(None)
+    if 'success' in cdd_results:
+        return cdd_results
+    return None
+
 
+# make pandas table from the resulting string
+@timed('ncbi.read_results')
+def read_ncbi_cdd_results(cdd_results):
+    df = pd.read_csv(StringIO(cdd_results.split("\n\n")[1]), sep="\t")
     return df
 
 
@@ -149,7 +377,14 @@ def add_gi_to_ncbi_query_results(ncbi_results):
     return ncbi_results
 
 
-def get_cdd_descriptions(accession_list, num_processes=5):
+# Descriptions are looked up in the index made from NCBI's cddid table first,
+# then in the annotation cache, and only the rest are downloaded. Set
+# index_file or cache_file to None to skip them. A caller making many lookups
+# can pass an open description cache as cache, it is used instead of
+# cache_file and left open.
+def get_cdd_descriptions(accession_list, num_threads=8,
+                         cache_file=CACHE_FILE, index_file=CDD_INDEX_FILE,
+                         cache=None):
     # if not a list, typecast single one to list
     if isinstance(accession_list, int) or isinstance(accession_list, str):
         accession_list = [accession_list]
@@ -160,29 +395,180 @@ def get_cdd_descriptions(accession_list, num_processes=5):
     accession_list = list(set(accession_list))
     start_time = time.time()
 
-    # divide into three pocesses
-    # num_processes = 5
-    desct_list = []
-    with Pool(num_processes) as p:
-        desct_list = p.map(get_single_cdd_description, accession_list)
+    # descriptions from the cddid index
+    index_df = lookup_cdd_index(accession_list, index_file)
+    indexed = set(index_df['accession'])
+    missing_list = [a for a in accession_list if a not in indexed]
+    if index_file is not None:
+        print('CDD description index: {} of {} accessions'.format(
+              len(indexed), len(accession_list)))
+        metrics.count('cdd_descriptions.index_hits', len(indexed))
+
+    # check the cache for descriptions that have already been downloaded
+    own_cache = cache is None
+    descriptions = {}
+    fetch_list = missing_list
+    if own_cache and cache_file is not None and len(missing_list) > 0:
+        cache = get_cdd_description_cache(cache_file)
+    if cache is not None and len(missing_list) > 0:
+        descriptions = cache.get_many(missing_list)
+        fetch_list = [a for a in missing_list if a not in descriptions]
+        hits = len(missing_list) - len(fetch_list)
+        print('CDD description cache: {} hits, {} misses'.format(
+              hits, len(fetch_list)))
+        metrics.count('cdd_descriptions.cache_hits', hits)
+        metrics.count('cdd_descriptions.cache_misses', len(fetch_list))
+
+    # the pages are downloaded on threads that are kept between calls, so
+    # their connections to ncbi are too
+    if len(fetch_list) > 0:
+        executor = get_description_executor(num_threads)
+        desct_list = list(executor.map(get_single_cdd_description,
+                                       fetch_list))
+        print('NCBI requests: {}'.format(ncbi_scheduler.summary()))
+        fetched = dict(zip(fetch_list, desct_list))
+        descriptions.update(fetched)
+        if cache is not None:
+            cache_cdd_descriptions(cache, fetched)
+
+    if own_cache and cache is not None:
+        cache.close()
+
+    print('Threads {} run time {}'.format(num_threads, time.time()-start_time))
+    print('len desct list: ', len(index_df) + len(descriptions), ' len acc: ',
+          len(accession_list))
+
+    desct_df = pd.DataFrame({'accession': missing_list, 'cdd_description':
+                             [descriptions[a] for a in missing_list]})
+    desct_df = pd.concat([index_df, desct_df], ignore_index=True)
 
-    print('Processes {} run time {}'.format(num_processes, time.time()-start_time))
-    print('len desct list: ', len(desct_list), ' len acc: ', len(accession_list))
+    return desct_df
 
-    desct_df = pd.DataFrame({'accession': accession_list, 'cdd_description':
-                             desct_list})
 
-    return desct_df
+# Returns a data frame with the accession and cdd_description of each
+# accession in the cddid index, accessions that aren't in it are left out
+def lookup_cdd_index(accession_list, index_file=CDD_INDEX_FILE):
+    index_dfs = [pd.DataFrame(columns=['accession', 'cdd_description'])]
+    if index_file is None or not os.path.exists(index_file):
+        return index_dfs[0]
+    connection = sqlite3.connect(index_file)
+    # sqlite limits how many variables a query can have
+    for i in range(0, len(accession_list), 500):
+        sub_list = accession_list[i:(i+500)]
+        index_dfs.append(pd.read_sql_query(
+            'select accession, description as cdd_description from cddid '
+            'where accession in ({})'.format(', '.join('?' for a in sub_list)),
+            connection, params=sub_list))
+    connection.close()
+    return pd.concat(index_dfs, ignore_index=True)
+
+
+# Build the description index from NCBI's cddid table, a gzipped tab
+# separated file with the PSSM id, accession, short name, description and
+# PSSM length of every conserved domain. source can be a url or a file. The
+# index is built in a table of its own and swapped in when it is complete,
+# so runs reading the old one never see it empty.
+def build_cdd_index(source=CDDID_URL, index_file=CDD_INDEX_FILE):
+    # a download is saved without the .gz of its url
+    compression = 'infer'
+    if urllib.parse.urlsplit(source).path.endswith('.gz'):
+        compression = 'gzip'
+    if '://' in source:
+        print('Downloading {}'.format(source))
+        source, headers = urllib.request.urlretrieve(source)
+    directory = os.path.dirname(index_file)
+    if directory != '':
+        os.makedirs(directory, exist_ok=True)
+
+    connection = sqlite3.connect(index_file)
+    connection.execute('drop table if exists cddid_new')
+    connection.execute('create table cddid_new (pssm_id text, accession text '
+                       'primary key, short_name text, description text, '
+                       'pssm_length text)')
+    num_rows = 0
+    for chunk in pd.read_csv(source, sep='\t', header=None, dtype=str,
+                             names=['pssm_id', 'accession', 'short_name',
+                                    'description', 'pssm_length'],
+                             compression=compression, quoting=csv.QUOTE_NONE,
+                             chunksize=10000):
+        chunk = chunk.where(chunk.notnull(), None)
+        connection.executemany(
+            'replace into cddid_new values (?, ?, ?, ?, ?)',
+            chunk.values.tolist())
+        num_rows += len(chunk)
+    connection.commit()
+    urllib.request.urlcleanup()
+
+    # replace the old index in one transaction
+    connection.isolation_level = None
+    connection.execute('begin')
+    connection.execute('drop table if exists cddid')
+    connection.execute('alter table cddid_new rename to cddid')
+    connection.execute('commit')
+    connection.close()
+    print('Indexed {} conserved domains in {}'.format(num_rows, index_file))
+
+
+# Threads that download description pages, one pool for each number of
+# threads asked for, kept for the life of the process
+def get_description_executor(num_threads):
+    with description_lock:
+        if num_threads not in description_executors:
+            description_executors[num_threads] = ThreadPoolExecutor(
+                num_threads, thread_name_prefix='cdd-descriptions')
+        return description_executors[num_threads]
+
+
+# Send requests for searches and descriptions to url instead of ncbi, like a
+# mirror or a local test server, allowing rate requests a second
+def set_ncbi_url(url, rate=None):
+    global ncbi_client, ncbi_scheduler
+    ncbi_client.close()
+    if rate is not None:
+        ncbi_scheduler = RequestScheduler(rate)
+    ncbi_client = HttpClient(url, scheduler=ncbi_scheduler)
+
+
+def get_cdd_description_cache(cache_file=CACHE_FILE):
+    return AnnotationCache('cdd_descriptions', cache_file,
+                           ttl=DESCRIPTION_TTL,
+                           max_entries=DESCRIPTION_CACHE_SIZE)
+
+
+# Store downloaded descriptions, empty ones are kept for a shorter time so
+# accessions that failed are tried again later
+def cache_cdd_descriptions(cache, descriptions):
+    found = {a: d for a, d in descriptions.items() if d != ''}
+    not_found = {a: d for a, d in descriptions.items() if d == ''}
+    cache.put_many(found)
+    cache.put_many(not_found, ttl=MISSING_DESCRIPTION_TTL)
+
+
+# Download descriptions for a file of accessions, one per line, into the
+# cache so later runs don't have to
+def prefetch_cdd_descriptions(accession_file, num_threads=8,
+                              cache_file=CACHE_FILE):
+    with open(accession_file) as f:
+        accession_list = [x.strip() for x in f.readlines() if x.strip() != '']
+    desct_df = get_cdd_descriptions(accession_list, num_threads, cache_file)
+    print('Cached descriptions for {} accessions'.format(len(desct_df)))
 
 
 # Uses accession number from conserved domains to get description from
-# webpage
-def get_single_cdd_description(cdd_accession):
+# webpage. If a cache is given the webpage is only downloaded when the
+# description isn't already in it.
+@timed('ncbi.get_single_cdd_description')
+def get_single_cdd_description(cdd_accession, cache=None):
+    if cache is not None:
+        description = cache.get(cdd_accession)
+        if description is not None:
+            return description
+
     description = ""
     # get webpage using accession id for conserved domain
-    url = 'https://www.ncbi.nlm.nih.gov/Structure/cdd/' + cdd_accession
+    url = '/Structure/cdd/' + cdd_accession
     try:
-        webpage = BeautifulSoup(urllib.request.urlopen(url).read(),
+        webpage = BeautifulSoup(ncbi_client.get(url, DESCRIPTION),
                                 features='html.parser')
 
 
@@ -203,6 +589,8 @@ def get_single_cdd_description(cdd_accession):
     except ConnectionResetError as e:
         print(e)
 
+    if cache is not None:
+        cache_cdd_descriptions(cache, {cdd_accession: description})
     return description
 
 
@@ -223,3 +611,25 @@ def filter_output(df, filters):
             print('Not known options to filter: {}'.format(', '.join(bad_filters)))
 
     return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Prepare conserved domain descriptions ahead of a run.')
+    commands = parser.add_subparsers(dest='command')
+    index_parser = commands.add_parser(
+        'index', help="build the description index from NCBI's cddid table")
+    index_parser.add_argument('source', nargs='?', default=CDDID_URL,
+                              help='cddid.tbl.gz file or url')
+    prefetch_parser = commands.add_parser(
+        'prefetch', help='download descriptions into the cache')
+    prefetch_parser.add_argument('accession_file',
+                                 help='file with one accession per line')
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        build_cdd_index(args.source)
+    elif args.command == 'prefetch':
+        prefetch_cdd_descriptions(args.accession_file)
+    else:
+        parser.print_help()
@@ -1,68 +1,108 @@
 import microbes_online as mo
 import conserved_domains as cdd
+from checkpoint import RunCheckpoint
+from output_writer import (OutputWriter, OUTPUT_FORMATS, check_output_format,
+                           default_compression, format_from_name, read_output,
+                           whole_genes)
+from run_metrics import metrics, timed, Profiler
+from compact_frames import (BatchCollector, SPILL_LIMIT_MB, fill_blanks,
+                            memory_report, read_batch)
+from ncbi_http import NCBI_REQUESTS_PER_SECOND
 import pandas as pd
+import numpy as np
 import datetime as dt
 import time
-import sys
-
-try:
-    gene_file = sys.argv[1]
-except:
-    print('Need a file to read genes from.')
-    sys.exit(1)
-
-try:
-    output_file = sys.argv[2]
-except:
-    print('Need an output file name.')
-
-# Merge columns of information that must stay together when reducing
-# information based on how many unique values there are
-def merge_columns(df, column_names):
-    for name in column_names.copy():
-        try:
-            temp = df[name]
-        except KeyError:
-            print('\tmerge_columns: {} not in dataframe, removing'.format(name))
-            # prevent second error
-            time.sleep(.1)
-            column_names.remove(name)
-
-    merged_column_name = '|||'.join(column_names)
-    print(column_names)
-    merged_columns = []
-
-    # merge columns that have values and leaves ones that don't blank
-    for i, row in df.iterrows():
-        joined_row = ''
-        for name in column_names:
-            if row[name] is None:
-                row[name] = ''
-            else:
-                row[name] = str(row[name])
-        joined_row = '|||'.join(row[column_names])
-        merged_columns.append(joined_row)
-
-    # add new column with merged columns
-    df[merged_column_name] = merged_columns
-
-    # remove old columns
-    df.drop(column_names, axis=1, inplace=True)
-    return(df, column_names)
-
-
-# make prevously merged columns into separate fields again
-def unmerge_columns(df, column_names):
-    merged_column_name = '|||'.join(column_names)
-    new_columns = pd.DataFrame([x.split('|||') for x in df[merged_column_name]],
-                               columns=column_names)
-    df = pd.concat([df, new_columns], axis=1)
-    df.drop(merged_column_name, axis=1, inplace=True)
-    return(df)
-
-
+import argparse
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# columns of the output file, in order
+OUTPUT_FIELDS = ['name', 'locus_id', 'organism', 'gene_name',
+                 'gene_description', 'cdd_name', 'e-value', 'cdd_description',
+                 'ipr_id', 'ipr_name', 'ipr_link', 'fun_code',
+                 'fun_code_description', 'fun_code_group', 'cog_info_id',
+                 'cog_description', 'tigr_description', 'go_id', 'go_name',
+                 'go_type', 'ncbi_accession_number', 'ncbi_gene_id', 'gi',
+                 'accession']
+
+
+# Lay out the unique values of every column for each gene, one value per row
+# and padded with blanks, so each gene gets as many rows as its column with
+# the most unique values. Columns in the same group keep their values
+# together, the unique combinations of the group are laid out as one. Uses one
+# drop_duplicates/cumcount pass per group instead of scanning the whole frame
+# once per gene. Categorical columns stay categorical.
+def unique_values_by_gene(df, column_groups=[]):
+    columns = df.columns.values
+    # rows without a gene name can not be grouped, drop them
+    df = fill_blanks(df[df['name'].notnull()])
+    genes = np.asarray(df['name'].unique(), dtype=object)
+
+    # columns that are not part of a group make up a group of their own
+    grouped_columns = [c for group in column_groups for c in group]
+    column_groups = [list(group) for group in column_groups]
+    column_groups += [[c] for c in columns
+                      if c != 'name' and c not in grouped_columns]
+
+    # for each group, the unique values of each gene in order of appearance
+    # numbered by the row they will end up on
+    group_values = []
+    # every gene needs at least one row for its name
+    num_rows = np.ones(len(genes), dtype=int)
+    for group in column_groups:
+        values = df[['name'] + group].drop_duplicates()
+        value_rows = values.groupby('name', sort=False,
+                                    observed=True).cumcount()
+        values.index = pd.MultiIndex.from_arrays(
+            [np.asarray(values['name'], dtype=object), value_rows.values])
+        values = values[group]
+        group_values.append(values)
+        num_unique_vals = values.groupby(level=0, sort=False).size()
+        num_rows = np.maximum(num_rows, num_unique_vals.reindex(genes).values)
+
+    # number the rows of each gene starting from zero
+    row_names = np.repeat(genes, num_rows)
+    row_numbers = np.arange(len(row_names)) - np.repeat(
+        np.cumsum(num_rows) - num_rows, num_rows)
+    index = pd.MultiIndex.from_arrays([row_names, row_numbers])
+
+    # fill in values by gene and row, leaving the rest blank
+    new_df = fill_blanks(pd.concat([values.reindex(index)
+                                    for values in group_values], axis=1))
+    new_df['name'] = row_names
+    new_df = new_df.reset_index(drop=True)
+    return(new_df[columns])
+
+
+# Reshape df genes_per_chunk genes at a time, yielding each chunk as soon as
+# it is ready. A gene's rows are always in the same chunk and genes keep the
+# order reshape_data would give them, or the order of genes if it is given
+# so the output doesn't depend on which genes came from the cache. Names are
+# matched to genes ignoring case, like the cache does.
+def reshape_in_chunks(df, genes_per_chunk=10000, genes=None):
+    if genes is None:
+        gene_codes, genes = pd.factorize(df['name'])
+    else:
+        names = df['name'].astype(object).str.lower()
+        genes = list(dict.fromkeys(g.lower() for g in genes))
+        genes = pd.Index(genes +
+                         list(names[~names.isin(genes)].dropna().unique()))
+        gene_codes = genes.get_indexer(names)
+    chunks = gene_codes // genes_per_chunk
+    for chunk in range(chunks.max() + 1 if len(chunks) > 0 else 0):
+        rows = chunks == chunk
+        # rows without a name have code -1 and are dropped by reshape_data
+        if rows.any():
+            # reshape_data keeps genes in the order their rows come in
+            order = np.argsort(gene_codes[rows], kind='stable')
+            yield reshape_data(df[rows].iloc[order])
+
+
+@timed('driver.reshape_data')
 def reshape_data(df):
-    # merge columns where values must stay together
+    # columns where values must stay together
     GO_columns = ['go_id',
                   'go_name',
                   'go_type']
@@ -70,137 +110,457 @@ def reshape_data(df):
                         'ipr_name']
     cdd_columns = ['accession','cdd_name',
                    'e-value', 'cdd_description']
-    # convert E-Vlaue to strings
-    df, go_names = merge_columns(df, GO_columns)
-    df, ipr_names = merge_columns(df, interpro_columns)
-    df, cdd_names = merge_columns(df, cdd_columns)
-
-    # find unique list of genes
-    genes = df['name'].unique()
-    new_rows = []
-    columns = df.columns.values
-
-    # look through all genes and find uniqe values for each gene
-    for gene in genes:
-        # get all rows and convert NaN to empty strings
-        rows = df[df['name'] == gene].fillna(value='')
-        num_rows = 0
-        for column in columns:
-            # compare old columns to new ones and take maximum values
-            num_unique_vals = len(set([x for x in rows[column]]))
-            num_rows = max(num_rows, num_unique_vals)
-
-        # build new part of data frame for gene
-        for i in range(num_rows):
-            row_values = []
-            for column in columns:
-                col_vals = rows[column].unique()
-                # only include each vlaue once, unless it's the name
-                if i < len(col_vals):
-                    row_values.append(col_vals[i])
-                elif column == 'name':
-                    row_values.append(gene)
-                else:
-                    row_values.append('')
-            new_rows.append(row_values)
-    # write modifed data to df
-    df = pd.DataFrame(new_rows, columns=columns)
-
-    # make merged fields individual again
-    df = unmerge_columns(df, go_names)
-    df = unmerge_columns(df, ipr_names)
-    df = unmerge_columns(df, cdd_names)
 
+    column_groups = []
+    for group in [GO_columns, interpro_columns, cdd_columns]:
+        missing = [c for c in group if c not in df.columns]
+        if len(missing) > 0:
+            print('\treshape_data: {} not in dataframe, removing'.format(
+                  ', '.join(missing)))
+        group = [c for c in group if c in df.columns]
+        if len(group) > 0:
+            column_groups.append(group)
+
+    df = unique_values_by_gene(df, column_groups)
     return(df)
 
 
-def create_interpro_link(df):
+# Genes of shard index (from 0) when genes are split into count shards. The
+# shards are runs of consecutive genes, so their outputs joined in order
+# follow the gene list like the output of a single run.
+def shard_genes(genes, index, count):
+    genes = list(dict.fromkeys(genes))
+    return genes[(len(genes)*index//count):(len(genes)*(index+1)//count)]
+
+
+# (index from 0, count) of a shard given as I/N, I from 1 to N
+def parse_shard(text):
+    try:
+        number, count = [int(n) for n in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be I/N, like 2/8')
+    if count < 1 or number < 1 or number > count:
+        raise argparse.ArgumentTypeError('shard must be I/N with I from 1 '
+                                         'to N')
+    return number - 1, count
+
+
+# Link to the interpro page of each row's ipr_id, as a spreadsheet HYPERLINK
+# formula if formula is True, otherwise just the url
+def create_interpro_link(df, formula=True):
     # url for interpro website information
     url = 'https://www.ebi.ac.uk/interpro/entry/'
-
-    # an empty list to hold hyperlinks
-    interpro_links = []
-    for ipr in df['ipr_id']:
-        link = ''
-        # check if there is an interpro id, if so make hyperlink
-        if isinstance(ipr, str):
-            link = '=HYPERLINK("' + url + ipr + '")'
-        interpro_links.append(link)
-
-    # add hyperlink list to df and return
-    df['ipr_link'] = interpro_links
+    template = '{}{}'
+    if formula:
+        template = '=HYPERLINK("{}{}")'
+
+    # make the hyperlink once for each interpro id, rows without an id get a
+    # blank link
+    ipr = df['ipr_id'].astype('category')
+    links = [template.format(url, i) for i in ipr.cat.categories]
+    codes = np.where(ipr.cat.codes.values == -1, len(links),
+                     ipr.cat.codes.values)
+
+    # add hyperlinks to df and return
+    df['ipr_link'] = pd.Categorical.from_codes(codes, links + [''])
     return(df)
 
 
-def read_tmp_csv(name):
-    df = pd.read_csv('tmp/' + name, dtype=str)
+# Microbes online rows with the conserved domains of their GI and the
+# descriptions of those domains
+def join_annotations(mo_df, cdd_df, desct_df):
+    df = pd.merge(mo_df, cdd_df, how='left')
+    return pd.merge(df, desct_df, how='left')
+
+
+# Genes in the output file of an earlier run
+def read_previous_genes(file_name, output_format):
+    genes = set()
+    for df in read_output(file_name, output_format, columns=['name']):
+        genes.update(df['name'])
+    return genes
+
+
+# Rows of an earlier run's output for the genes that are still in genes, as
+# they were written, a chunk of whole genes at a time. If formula is given the
+# interpro links are made again, as formulas or urls.
+def previous_rows(file_name, output_format, genes, columns, formula=None):
+    genes = set(genes)
+    for df in whole_genes(read_output(file_name, output_format)):
+        df = df[df['name'].isin(genes)].reindex(columns=columns)
+        if len(df) == 0:
+            continue
+        if formula is not None:
+            blank = df['ipr_id'].isnull() | (df['ipr_id'] == '')
+            df = create_interpro_link(df.copy(), formula)
+            df['ipr_link'] = df['ipr_link'].astype(object).where(~blank, '')
+        yield df
+
+
+# Put batch on a queue, waiting while it is full unless the stage reading the
+# queue has stopped. Returns False if the batch couldn't be sent.
+def send(batch_queue, batch, closed):
+    while not closed.is_set():
+        try:
+            batch_queue.put(batch, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+# Run the microbes online, conserved domain search and description stages at
+# the same time for gene_file, a file or list of genes. The GIs of each
+# microbes online batch go on to the conserved domain search as soon as the
+# batch is done, and the accessions of each search result go on to the
+# description download. The queues between the stages hold at most
+# queue_size batches and end with None. Returns the data frames the three
+# stages would have returned on their own. With a checkpoint, batches
+# finished in an earlier run are reused. Batches are written to disk once
+# each stage's take more than spill_mb.
+def run_pipeline(gene_file, fields, mo_options={}, queue_size=4,
+                 run_by_batch=250, max_concurrent=4, checkpoint=None,
+                 spill_mb=SPILL_LIMIT_MB):
+    gi_batches = queue.Queue(queue_size)
+    accession_batches = queue.Queue(queue_size)
+    # set when the stage reading a queue stops, so a failed stage doesn't
+    # leave the one before it waiting
+    gis_closed = threading.Event()
+    accessions_closed = threading.Event()
+    mo_batches = BatchCollector(spill_mb)
+    cdd_batches = BatchCollector(spill_mb)
+    desct_dfs = []
+    done_gis = set()
+    # accessions of searches finished in an earlier run
+    done_accessions = set()
+    if checkpoint is not None:
+        done_gis = checkpoint.done_items('cdd')
+        for file_name in checkpoint.batch_files('cdd'):
+            done_accessions.update(read_batch(file_name)['accession'])
+            cdd_batches.add_file(file_name)
+
+    def microbes_online_stage():
+        seen_gis = set(done_gis)
+        try:
+            all_genes = mo.gene_list(gene_file)
+            for raw_df, file_name in mo.get_microbes_online_batches(
+                    all_genes, checkpoint=checkpoint, **mo_options):
+                mo_batches.add(raw_df, file_name)
+                gis = [gi for gi in raw_df['gi'].dropna().astype(str).unique()
+                       if gi not in seen_gis]
+                seen_gis.update(gis)
+                for i in range(0, len(gis), run_by_batch):
+                    if not send(gi_batches, gis[i:(i+run_by_batch)],
+                                gis_closed):
+                        return
+        finally:
+            send(gi_batches, None, gis_closed)
+
+    def cdd_search_stage():
+        # descriptions for accessions found in earlier runs go first
+        seen_accessions = set(done_accessions)
+        try:
+            if len(seen_accessions) > 0:
+                send(accession_batches, list(seen_accessions),
+                     accessions_closed)
+            for sub_gis, query_results in cdd.query_ncbi_cdd_batches(
+                    gi_batches, max_concurrent):
+                if query_results is None:
+                    continue
+                df_acc_id = cdd.get_accession_information(query_results)
+                file_name = None
+                if checkpoint is not None:
+                    file_name = checkpoint.save('cdd', sub_gis, df_acc_id)
+                cdd_batches.add(df_acc_id, file_name)
+                accessions = [a for a in df_acc_id['accession'].unique()
+                              if a not in seen_accessions]
+                seen_accessions.update(accessions)
+                if len(accessions) > 0:
+                    if not send(accession_batches, accessions,
+                                accessions_closed):
+                        return
+        finally:
+            gis_closed.set()
+            send(accession_batches, None, accessions_closed)
+
+    def description_stage():
+        try:
+            accessions = accession_batches.get()
+            while accessions is not None:
+                desct_dfs.append(cdd.get_cdd_descriptions(accessions))
+                accessions = accession_batches.get()
+        finally:
+            accessions_closed.set()
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        stages = [executor.submit(microbes_online_stage),
+                  executor.submit(cdd_search_stage),
+                  executor.submit(description_stage)]
+        for stage in stages:
+            stage.result()
+
+    mo_df = mo_batches.result()
+    if mo_df is None:
+        mo_df = pd.DataFrame(columns=fields)
+    mo_df = mo.filter_output(mo_df, fields)
+    cdd_df = cdd_batches.result()
+    if cdd_df is None:
+        cdd_df = pd.DataFrame(columns=['gi', 'accession', 'cdd_name'])
+    else:
+        cdd_df = cdd.filter_output(cdd_df, fields)
+    desct_df = pd.DataFrame(columns=['accession', 'cdd_description'])
+    if len(desct_dfs) > 0:
+        desct_df = pd.concat(desct_dfs, ignore_index=True)
+    print('NCBI CDD searches: {}'.format(cdd.search_stats.summary()))
+    print('NCBI requests: {}'.format(cdd.ncbi_scheduler.summary()))
+    return(mo_df, cdd_df, desct_df)
+
 
 if __name__ == '__main__':
-    fields = ['name', 'locus_id', 'organism', 'gene_name', 'gene_description',
-            'cdd_name', 'e-value', 'cdd_description', 'ipr_id', 'ipr_name',
-            'ipr_link', 'fun_code', 'fun_code_description',
-            'fun_code_group', 'cog_info_id', 'cog_description',
-            'tigr_description', 'go_id', 'go_name', 'go_type',
-            'ncbi_accession_number', 'ncbi_gene_id', 'gi', 'accession']
+    parser = argparse.ArgumentParser(
+        description='Annotate a list of genes from Microbesonline and NCBI '
+                    'Conserved Domains.')
+    parser.add_argument('gene_file', help='file with one gene name per line')
+    parser.add_argument('output_file', help='file to write to')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS,
+                        help='output format, by default from the output '
+                             'file name (.parquet, .arrow, .feather, .csv '
+                             'with .gz, .bz2 or .xz) or csv')
+    parser.add_argument('--compression',
+                        help='csv: gzip, bz2 or xz; parquet: snappy '
+                             '(default), gzip, brotli, zstd, lz4 or none; '
+                             'arrow: lz4 or zstd')
+    parser.add_argument('--chunk-genes', type=int, default=10000,
+                        help='genes to reshape and write at a time')
+    parser.add_argument('--query-mode', default='joined',
+                        choices=['joined', 'narrow', 'streaming'],
+                        help='how to query microbes online')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='microbes online batches to query at once')
+    parser.add_argument('--batch-size', type=int, default=250,
+                        help='genes in each microbes online batch, streaming '
+                             'mode can take much larger ones')
+    parser.add_argument('--fetch-size', type=int, default=10000,
+                        help='rows streaming mode reads at a time')
+    parser.add_argument('--backend', default='mysql',
+                        choices=['mysql', 'local'],
+                        help='query pub.microbesonline.org or the local copy '
+                             'made with local_mirror.py')
+    parser.add_argument('--mirror-file', default=mo.MIRROR_FILE,
+                        help='local copy of microbes online for --backend '
+                             'local')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='run the microbes online and conserved domain '
+                             'stages at the same time')
+    parser.add_argument('--resume', action='store_true',
+                        help='reuse batches finished by an earlier run of '
+                             'the same gene list')
+    parser.add_argument('--previous',
+                        help='output of an earlier run to update, only genes '
+                             'that are not in it are annotated and genes no '
+                             'longer in gene_file are dropped')
+    parser.add_argument('--shard', type=parse_shard,
+                        help='annotate only shard I/N of the gene list, '
+                             'shards.py runs and merges them')
+    parser.add_argument('--ncbi-rate', type=float,
+                        default=NCBI_REQUESTS_PER_SECOND,
+                        help='NCBI requests per second, split it between '
+                             'runs going at the same time')
+    parser.add_argument('--spill-mb', type=int, default=SPILL_LIMIT_MB,
+                        help='MB of batches to keep in memory per stage '
+                             'before writing them to disk')
+    parser.add_argument('--report',
+                        help='json file to write run metrics to, default is '
+                             'the output file with .report.json added')
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc', 'all'],
+                        help='profile the run with cProfile, tracemalloc or '
+                             'both, results are added to the report')
+    args = parser.parse_args()
+    gene_file = args.gene_file
+    output_file = args.output_file
+    output_format, compression = format_from_name(output_file)
+    if args.format is not None and args.format != output_format:
+        output_format = args.format
+        compression = default_compression(output_format)
+    if args.compression is not None:
+        compression = args.compression
+        if compression == 'none':
+            compression = None
+    # fail now rather than after the whole run
+    try:
+        check_output_format(output_format, compression)
+    except (ValueError, ImportError) as e:
+        parser.error(str(e))
+    mo_options = {'query_mode': args.query_mode, 'workers': args.workers,
+                  'backend': args.backend, 'mirror_file': args.mirror_file,
+                  'run_by_batch': args.batch_size,
+                  'fetch_size': args.fetch_size}
+    genes = mo.file_as_list(gene_file)
+    if args.shard is not None:
+        genes = shard_genes(genes, *args.shard)
+        print('Shard {}/{}: {} genes'.format(args.shard[0] + 1, args.shard[1],
+                                             len(genes)))
+    if args.ncbi_rate != NCBI_REQUESTS_PER_SECOND:
+        cdd.ncbi_scheduler.set_rate(args.ncbi_rate)
+
+    # with an earlier output only the genes added since are annotated
+    run_genes = genes
+    delta = None
+    if args.previous is not None:
+        previous_format = format_from_name(args.previous)[0]
+        try:
+            check_output_format(previous_format,
+                                default_compression(previous_format))
+            previous_genes = read_previous_genes(args.previous,
+                                                 previous_format)
+        except (ValueError, ImportError, OSError) as e:
+            parser.error('can not read {}: {}'.format(args.previous, e))
+        run_genes = [g for g in dict.fromkeys(genes)
+                     if g not in previous_genes]
+        delta = {'previous': args.previous,
+                 'previous_genes': len(previous_genes),
+                 'kept_genes': len(previous_genes.intersection(genes)),
+                 'removed_genes': len(previous_genes.difference(genes)),
+                 'added_genes': len(run_genes)}
+        print('Previous output {}: {} genes kept, {} removed, {} to '
+              'annotate'.format(args.previous, delta['kept_genes'],
+                                delta['removed_genes'], len(run_genes)))
+    # results from another source or query mode aren't resumed
+    run_inputs = {'genes': run_genes, 'query_mode': args.query_mode,
+                  'backend': args.backend}
+    if args.backend == 'local':
+        run_inputs['mirror_file'] = os.path.abspath(args.mirror_file)
+    checkpoint = RunCheckpoint(run_inputs, resume=args.resume)
+
+    fields = OUTPUT_FIELDS
+
+    report_file = args.report
+    if report_file is None:
+        report_file = output_file + '.report.json'
+    profiler = Profiler(args.profile)
+    profiler.start()
 
     start_time = time.time()
     print("Application started at {}".format(dt.datetime.now().time()))
 
-    print('\n*** Microbes Online {}'.format(''.join(['*' for x in range(10)])))
-
-    # 1. send fileds to microbes_online and get df with that information
-    mo_df = mo.get_microbes_online_df(gene_file, fields)
-    mo_time = time.time()
-    print("Return microbes online dataframe: {0:.4f} sec\n".format(mo_time-start_time))
-
-    #mo_df = pd.read_csv('tmp/tmp-microbes-online-laura-genes-1000.txt-2019-04-14 13:47:12.312666.csv', dtype=str)
-    #mo_time = time.time()
-
-
-    # 2. Create an interpo link from 'iprId'
-    print('\n*** Creating interpro links {}'.format(''.join(['*' for x in range(10)])))
-    mo_df = create_interpro_link(mo_df)
-    ipr_time = time.time()
-    print("Create interpro links: {0:.4f} sec\n".format(ipr_time - mo_time))
-
-
-    # 3. Get conserved domain information using 'GI'
-    print('\n*** Conserved Domains {}'.format(''.join(['*' for x in range(10)])))
-    gi_list = mo_df['gi']
-    cdd_df = cdd.get_cdd_information_from_gi(gi_list, fields)
-    cdd_time = time.time()
-    print("Get conserved domain info: {0:.4f} sec\n".format(cdd_time-ipr_time))
-
-    #cdd_df = pd.read_csv('tmp/tmp-cdd-information-2019-04-14 13:49:20.305633.csv', dtype=str)
-
-    # 3.5 Get cdd description using accession information
-    print('\n*** Conserved Domains description {}'.format(''.join(['*' for x in range(10)])))
-    acc_list = cdd_df['accession']
-    desct_df = cdd.get_cdd_descriptions(acc_list)
-    desct_time = time.time()
-    print("Get conserved domain description: {0:.4f} sec\n".format(desct_time-cdd_time))
+    if args.pipelined:
+        # 1-3.5 all stages at once
+        print('\n*** Pipelined Microbes Online and Conserved Domains {}'.format(''.join(['*' for x in range(10)])))
+        mo_df, cdd_df, desct_df = run_pipeline(run_genes, fields, mo_options,
+                                               checkpoint=checkpoint,
+                                               spill_mb=args.spill_mb)
+        mo_df = create_interpro_link(mo_df, output_format == 'csv')
+        desct_time = time.time()
+        print("Pipelined stages: {0:.4f} sec\n".format(desct_time-start_time))
+        metrics.add_time('stage.pipelined', desct_time-start_time)
+    else:
+        print('\n*** Microbes Online {}'.format(''.join(['*' for x in range(10)])))
+
+        # 1. send fileds to microbes_online and get df with that information
+        mo_df = mo.get_microbes_online_df(run_genes, fields,
+                                          checkpoint=checkpoint,
+                                          spill_mb=args.spill_mb, **mo_options)
+        mo_time = time.time()
+        print("Return microbes online dataframe: {0:.4f} sec\n".format(mo_time-start_time))
+        metrics.add_time('stage.microbes_online', mo_time-start_time)
+
+
+        # 2. Create an interpo link from 'iprId'
+        print('\n*** Creating interpro links {}'.format(''.join(['*' for x in range(10)])))
+        mo_df = create_interpro_link(mo_df, output_format == 'csv')
+        ipr_time = time.time()
+        print("Create interpro links: {0:.4f} sec\n".format(ipr_time - mo_time))
+        metrics.add_time('stage.interpro_links', ipr_time-mo_time)
+
+
+        # 3. Get conserved domain information using 'GI'
+        print('\n*** Conserved Domains {}'.format(''.join(['*' for x in range(10)])))
+        gi_list = mo_df['gi']
+        cdd_df = cdd.get_cdd_information_from_gi(gi_list, fields,
+                                                 checkpoint=checkpoint,
+                                                 spill_mb=args.spill_mb)
+        if cdd_df is None:
+            cdd_df = pd.DataFrame(columns=['gi', 'accession', 'cdd_name'])
+        cdd_time = time.time()
+        print("Get conserved domain info: {0:.4f} sec\n".format(cdd_time-ipr_time))
+        metrics.add_time('stage.conserved_domains', cdd_time-ipr_time)
+
+        # 3.5 Get cdd description using accession information
+        print('\n*** Conserved Domains description {}'.format(''.join(['*' for x in range(10)])))
+        acc_list = cdd_df['accession']
+        desct_df = cdd.get_cdd_descriptions(acc_list)
+        desct_time = time.time()
+        print("Get conserved domain description: {0:.4f} sec\n".format(desct_time-cdd_time))
+        metrics.add_time('stage.cdd_descriptions', desct_time-cdd_time)
 
 
     # 4. join cdd and mo df
     print('\n*** Joining dataframes {}'.format(''.join(['*' for x in range(10)])))
-    df = pd.merge(mo_df, cdd_df, how='left')
-    df = pd.merge(df, desct_df, how='left')
+    df = join_annotations(mo_df, cdd_df, desct_df)
     merge_time = time.time()
     print("Merge cdd and mo data frames: {0:.4f} sec\n".format(merge_time-desct_time))
-
-
-    # 5. Reformat data to desired output
-    print('\n*** Reformat dataframe {}'.format(''.join(['*' for x in range(10)])))
-    df = reshape_data(df)
-    reshape_time = time.time()
-    print("Reshape data: {0:.4f} sec\n".format(reshape_time-merge_time))
-
+    metrics.add_time('stage.merge', merge_time-desct_time)
+    memory = {'microbes_online': memory_report(mo_df),
+              'conserved_domains': memory_report(cdd_df),
+              'cdd_descriptions': memory_report(desct_df),
+              'merged': memory_report(df)}
+    print("Merged data frame: {} rows, {} MB\n".format(
+          len(df), memory['merged']['total_mb']))
+
+
+    # 5. Reformat data to desired output and 6. write it, a chunk of genes
+    # at a time
+    print('\n*** Reformat dataframe and write {} file {}'.format(
+          output_format, ''.join(['*' for x in range(10)])))
+    memory['reshaped_chunk_max_mb'] = 0
+    # an output that replaces the previous one is written next to it first
+    write_file = output_file
+    if args.previous is not None and \
+            os.path.abspath(args.previous) == os.path.abspath(output_file):
+        write_file = output_file + '.partial'
     #TODO: rename lous_id to vimss id
-    # 6. Write to csv
-    print('\n*** Print to csv file {}'.format(''.join(['*' for x in range(10)])))
-    # or compare fields to current columns
-    df = df.reindex(columns=fields)
-    df.to_csv(output_file, index=False)
+    with OutputWriter(write_file, fields, output_format,
+                      compression) as writer:
+        # rows of the genes kept from the previous output go first, as they
+        # are, followed by the added genes
+        if args.previous is not None:
+            with metrics.timer('stage.previous_rows'):
+                # csv output has formula links and the other formats urls
+                formula = None
+                if (previous_format == 'csv') != (output_format == 'csv'):
+                    formula = output_format == 'csv'
+                for chunk in previous_rows(args.previous, previous_format,
+                                           genes, fields, formula):
+                    writer.write(chunk)
+            delta['previous_rows'] = writer.rows
+        chunks = reshape_in_chunks(df, args.chunk_genes, run_genes)
+        while True:
+            with metrics.timer('stage.reshape'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            memory['reshaped_chunk_max_mb'] = max(
+                memory['reshaped_chunk_max_mb'],
+                memory_report(chunk)['total_mb'])
+            with metrics.timer('stage.write'):
+                writer.write(chunk)
+    if write_file != output_file:
+        os.replace(write_file, output_file)
+    # the output is complete, there is nothing left to resume
+    checkpoint.remove()
+    write_time = time.time()
+    print("Reshape and write {} rows: {:.4f} sec\n".format(
+          writer.rows, write_time-merge_time))
 
     print("Application finished at: {}".format(dt.datetime.now()))
     print("Total runtime:: {0:.4f} sec".format((time.time()-start_time)))
+
+    # 7. Write the run report
+    run_info = {'arguments': vars(args), 'genes': len(genes),
+                'output_rows': writer.rows, 'output_genes': int(writer.genes),
+                'output_format': output_format, 'compression': compression,
+                'ncbi_searches': cdd.search_stats.summary(),
+                'ncbi_requests': cdd.ncbi_scheduler.stats(),
+                'memory': memory, 'delta': delta,
+                'profile': profiler.stop(report_file.rsplit('.json', 1)[0])}
+    metrics.write_report(report_file, run_info)
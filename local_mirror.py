@@ -0,0 +1,243 @@
+import microbes_online as mo
+from microbes_online import MIRROR_FILE
+import sqlite3
+import argparse
+import decimal
+import datetime
+import os
+
+# Tables used by query.txt and narrow-queries.txt and the columns to index
+# in each. Tables with a locusId column only get the rows for the exported
+# genes, the rest are lookup tables and are copied whole.
+TABLES = {'Synonym': ['name', 'locusId'],
+          'SynonymType': ['type'],
+          'Description': ['locusId'],
+          'COG': ['locusId', 'cogInfoId'],
+          'COGInfo': ['cogInfoId'],
+          'COGFun': ['funCode'],
+          'Locus2Domain': ['locusId', 'domainId'],
+          'TIGRInfo': ['tigrId'],
+          'TIGRroles': ['roleId'],
+          'Locus2Ipr': ['locusId', 'iprId'],
+          'IPRInfo': ['iprId'],
+          'Locus2Go': ['locusId', 'goID'],
+          'term': ['id'],
+          'Taxonomy': ['taxonomyId'],
+          'Locus': ['locusId'],
+          'LocusType': ['type'],
+          'AASeq': ['locusId']}
+
+# only the join column is needed from tables that are joined but not read
+EXPORT_COLUMNS = {'AASeq': 'locusId'}
+
+# rows per insert and ids per query
+BATCH_SIZE = 500
+
+
+def get_mirror(mirror_file=MIRROR_FILE):
+    directory = os.path.dirname(mirror_file)
+    if directory != '':
+        os.makedirs(directory, exist_ok=True)
+    return sqlite3.connect(mirror_file)
+
+
+# Make table with columns as text compared without case, like the microbes
+# online database does, replacing an existing one if replace is True
+def create_table(mirror, table, columns, replace=True):
+    if replace:
+        mirror.execute('drop table if exists "{}"'.format(table))
+    mirror.execute('create table if not exists "{}" ({})'.format(
+        table, ', '.join('"{}" text collate nocase'.format(c)
+                         for c in columns)))
+
+
+def create_indexes(mirror, tables=TABLES):
+    for table, columns in tables.items():
+        for column in columns:
+            try:
+                mirror.execute('create index if not exists "{0}_{1}" on '
+                               '"{0}" ("{1}")'.format(table, column))
+            except sqlite3.OperationalError as e:
+                # table wasn't imported or doesn't have the column
+                print('Could not index {}.{}: {}'.format(table, column, e))
+    mirror.commit()
+
+
+# mysql values sqlite can't store
+def to_sqlite_value(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.timedelta)):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def insert_rows(mirror, table, columns, rows):
+    mirror.executemany('insert into "{}" values ({})'.format(
+        table, ', '.join('?' for c in columns)),
+        [[to_sqlite_value(v) for v in row] for row in rows])
+
+
+# Copy the rows of query (with params) from microbes online into table
+def copy_query(connection, mirror, table, query, params=(), replace=True):
+    cursor = connection.cursor(buffered=False)
+    cursor.execute(query, params)
+    field_names = [i[0] for i in cursor.description]
+    create_table(mirror, table, field_names, replace)
+    num_rows = 0
+    rows = cursor.fetchmany(BATCH_SIZE)
+    while len(rows) > 0:
+        insert_rows(mirror, table, field_names, rows)
+        num_rows += len(rows)
+        rows = cursor.fetchmany(BATCH_SIZE)
+    cursor.close()
+    mirror.commit()
+    return num_rows
+
+
+# Copy the tables needed to annotate genes from microbes online into
+# mirror_file. With genes, only the rows for their loci are copied from the
+# tables with a locusId, otherwise whole tables are copied.
+def export_from_mysql(genes=None, mirror_file=MIRROR_FILE, tables=TABLES):
+    connection = mo.get_mysql_connection()
+    mirror = get_mirror(mirror_file)
+
+    loci = None
+    if genes is not None:
+        loci = []
+        for i in range(0, len(genes), BATCH_SIZE):
+            names = genes[i:(i+BATCH_SIZE)]
+            query = 'select distinct locusId from Synonym where name in '\
+                    '({})'.format(', '.join('%s' for g in names))
+            loci += [row[0] for rows, field_names in
+                     mo.stream_query(connection, query, tuple(names))
+                     for row in rows]
+        loci = list(dict.fromkeys(loci))
+        print('Exporting {} loci for {} genes'.format(len(loci), len(genes)))
+
+    for table, index_columns in tables.items():
+        columns = EXPORT_COLUMNS.get(table, '*')
+        query = 'select {} from {}'.format(columns, table)
+        if loci is None or 'locusId' not in index_columns:
+            num_rows = copy_query(connection, mirror, table, query)
+        else:
+            num_rows = 0
+            for i in range(0, len(loci), BATCH_SIZE):
+                sub_loci = loci[i:(i+BATCH_SIZE)]
+                num_rows += copy_query(
+                    connection, mirror, table,
+                    query + ' where locusId in ({})'.format(
+                        ', '.join('%s' for l in sub_loci)),
+                    tuple(sub_loci), replace=(i == 0))
+        print('Exported {} rows of {}'.format(num_rows, table))
+
+    connection.close()
+    create_indexes(mirror, tables)
+    mirror.close()
+
+
+# characters mysqldump --tab writes after a backslash, any other character
+# after a backslash stands for itself, like a backslash, tab or newline
+DUMP_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t',
+                'Z': '\x1a'}
+
+
+# Rows of a table dump written by mysqldump --tab. A newline after a
+# backslash is part of a value, not the end of the row.
+def dump_rows(f):
+    line = ''
+    for part in f:
+        line += part
+        value = line[:-1] if line.endswith('\n') else line
+        backslashes = len(value) - len(value.rstrip('\\'))
+        if line.endswith('\n') and backslashes % 2 == 1:
+            continue
+        yield split_dump_line(value)
+        line = ''
+    if line != '':
+        yield split_dump_line(line)
+
+
+# Values of a dump line, unescaped. \N on its own is NULL.
+def split_dump_line(line):
+    if '\\' not in line:
+        return line.split('\t')
+    row = []
+    value = []
+    start = 0
+    i = 0
+    while i <= len(line):
+        if i == len(line) or line[i] == '\t':
+            row.append(None if line[start:i] == '\\N' else ''.join(value))
+            value = []
+            start = i + 1
+        elif line[i] == '\\' and i + 1 < len(line):
+            i += 1
+            value.append(DUMP_ESCAPES.get(line[i], line[i]))
+        else:
+            value.append(line[i])
+        i += 1
+    return row
+
+
+# Load a tab separated table dump, like the ones made by mysqldump --tab,
+# into table. columns are the table's column names, if not given the first
+# line of the file is read as the header. \N is read as NULL and values are
+# unescaped like mysql's LOAD DATA does.
+def import_dump_file(table, file_name, columns=None, mirror_file=MIRROR_FILE):
+    mirror = get_mirror(mirror_file)
+    num_rows = 0
+    with open(file_name) as f:
+        if columns is None:
+            columns = f.readline().rstrip('\n').split('\t')
+        create_table(mirror, table, columns)
+        rows = []
+        for row in dump_rows(f):
+            rows.append(row)
+            if len(rows) == BATCH_SIZE:
+                insert_rows(mirror, table, columns, rows)
+                num_rows += len(rows)
+                rows = []
+        insert_rows(mirror, table, columns, rows)
+        num_rows += len(rows)
+    mirror.commit()
+    if table in TABLES:
+        create_indexes(mirror, {table: TABLES[table]})
+    mirror.close()
+    print('Imported {} rows of {}'.format(num_rows, table))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Make a local copy of the microbes online tables used to '
+                    'annotate genes.')
+    parser.add_argument('--mirror-file', default=MIRROR_FILE)
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser(
+        'export', help='copy tables from pub.microbesonline.org')
+    export_parser.add_argument('gene_file', nargs='?',
+                               help='only copy rows for these genes')
+    import_parser = commands.add_parser(
+        'import', help='load a tab separated table dump')
+    import_parser.add_argument('table', choices=sorted(TABLES))
+    import_parser.add_argument('dump_file')
+    import_parser.add_argument('--columns',
+                               help='comma separated column names, if the '
+                                    'file has no header line')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        genes = None
+        if args.gene_file is not None:
+            genes = mo.file_as_list(args.gene_file)
+        export_from_mysql(genes, args.mirror_file)
+    elif args.command == 'import':
+        columns = None
+        if args.columns is not None:
+            columns = args.columns.split(',')
+        import_dump_file(args.table, args.dump_file, columns,
+                         args.mirror_file)
+    else:
+        parser.print_help()
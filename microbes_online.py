@@ -1,55 +1,349 @@
 import mysql.connector
 from mysql.connector.errors import Error as MySQLError
 import pandas as pd
+import numpy as np
+from annotation_cache import AnnotationCache, CACHE_FILE
+from run_metrics import metrics, timed
+from compact_frames import compact, read_batch, BatchCollector, SPILL_LIMIT_MB
 from datetime import datetime as dt
 import os
 import time
+import functools
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+# queries for query_mode 'narrow'
+NARROW_QUERY_FILE = 'narrow-queries.txt'
+
+# local copy of the microbes online tables for backend 'local'
+MIRROR_FILE = 'cache/microbes-online-mirror.sqlite'
+
+# errors a batch is tried again for, RuntimeError is raised when a connection
+# can't be made and sqlite3.Error comes from the local backend, like a
+# mirror that is locked by local_mirror.py
+BATCH_ERRORS = (MySQLError, ConnectionResetError, RuntimeError, sqlite3.Error)
+
+# data frames a streaming batch may have waiting to be read
+FRAMES_PER_BATCH = 2
 
-# TODO: check database for gene, if doesn't have the query database
-def get_microbes_online_df(gene_file, fields, run_by_batch=250):
-    # make tmp dir if it doesn't exist
-    try:
-        os.makedirs("tmp/")
-    except FileExistsError:
-        pass
-    all_genes = file_as_list(gene_file)
-    # empty df to hold all gene information
-    temp_file_name = 'tmp/tmp-microbes-online-{}-{}.csv'.format(gene_file,
-                                                                dt.now())
-    # get information in chunks
-    connection = get_mysql_connection()
-    for i in range(0, len(all_genes), run_by_batch):
-        genes = []
-        # make sure genes gets correct indicies
-        if i + run_by_batch < len(all_genes):
-            genes = all_genes[i:(i+run_by_batch)]
-        else:
-            genes = all_genes[i:]
-
-        print("\n* Microbes_online now processing {}-{} genes of {}".format(
-              i+1, (i+len(genes)), len(all_genes)))
-
-        # make query and run
-        query = make_query(genes)
-        query_result, field_names = run_query(connection, query)
-
-        # return df with all possible result combinations
-        raw_df = postprocess_query_result(query_result, field_names)
-
-        # write to temporary csv file
-        with open(temp_file_name, 'a') as f:
-            if i == 0:
-                raw_df.to_csv(f, index=False)
-            else:
-                raw_df.to_csv(f, index=False, header=False)
 
-    connection.close()
-    final_df = pd.read_csv(temp_file_name, dtype=str)
+# Raised in a batch that is still running when the caller stops reading
+class BatchStopped(Exception):
+    pass
+
+
+# gene_file is a file with one gene per line or a list of genes. Genes found
+# in the annotation cache are reused, only the rest are queried from the
+# database. Set cache_file to None to always query the database.
+# query_mode 'joined' runs query.txt, 'narrow' runs one query per kind of
+# information in narrow-queries.txt and lines the results up in pandas.
+# 'streaming' loads each batch of genes into a temporary table, joins
+# query.txt against it and processes the result fetch_size rows at a time,
+# so much larger batches can be used. Up to workers batches are queried at
+# the same time, each over its own connection. With a checkpoint, genes from
+# batches that finished in an earlier run are not queried again. backend
+# 'local' queries the sqlite copy made by local_mirror.py in mirror_file
+# instead of pub.microbesonline.org. Batches are kept in memory until they
+# take more than spill_mb, then written to disk.
+def get_microbes_online_df(gene_file, fields, run_by_batch=250,
+                           cache_file=CACHE_FILE, query_mode='joined',
+                           fetch_size=10000, workers=1, checkpoint=None,
+                           backend='mysql', mirror_file=MIRROR_FILE,
+                           spill_mb=SPILL_LIMIT_MB):
+    all_genes = gene_list(gene_file)
+    batches = BatchCollector(spill_mb)
+    for raw_df, file_name in get_microbes_online_batches(
+            all_genes, run_by_batch, cache_file, query_mode, fetch_size,
+            workers, checkpoint, backend, mirror_file):
+        batches.add(raw_df, file_name)
+
+    final_df = batches.result()
+    if final_df is None:
+        print('Microbes online found no information for list of genes')
+        final_df = pd.DataFrame(columns=fields)
     final_df = filter_output(final_df, fields)
     return final_df
 
 
+# Yields the post-processed data frames for all_genes as they are ready,
+# first the genes finished in an earlier run and the genes found in the
+# cache, then each batch queried in order. Each comes with the checkpoint
+# file it is saved in, or None, so it isn't written to disk again. With a
+# checkpoint a batch is given whole once it is saved. The options are the
+# same as for get_microbes_online_df.
+def get_microbes_online_batches(all_genes, run_by_batch=250,
+                                cache_file=CACHE_FILE, query_mode='joined',
+                                fetch_size=10000, workers=1, checkpoint=None,
+                                backend='mysql', mirror_file=MIRROR_FILE):
+    connect = get_mysql_connection
+    if backend == 'local':
+        if query_mode == 'streaming':
+            raise ValueError('query mode streaming needs the mysql backend')
+        connect = functools.partial(get_mirror_connection, mirror_file)
+
+    query_genes = list(dict.fromkeys(all_genes))
+
+    # reuse batches that finished before the run stopped
+    if checkpoint is not None:
+        done_genes = checkpoint.done_items('microbes_online')
+        query_genes = [g for g in query_genes if g not in done_genes]
+        for file_name in checkpoint.batch_files('microbes_online'):
+            yield read_batch(file_name), file_name
+        print("Microbes online checkpoint: {} genes already done".format(
+              len(done_genes)))
+
+    # check the cache for genes that have already been looked up
+    cache = None
+    if cache_file is not None:
+        cache = AnnotationCache('microbes_online', cache_file)
+        cached = cache.get_many(query_genes)
+        query_genes = [g for g in query_genes if g not in cached]
+        cached_rows = [row for g in cached for row in cached[g]]
+        print("Microbes online cache: {} hits, {} misses".format(cache.hits,
+                                                                 cache.misses))
+        metrics.count('microbes_online.cache_hits', cache.hits)
+        metrics.count('microbes_online.cache_misses', cache.misses)
+        if len(cached_rows) > 0:
+            yield pd.DataFrame(cached_rows), None
+
+    # get information in chunks, workers batches at a time
+    batches = [query_genes[i:(i+run_by_batch)]
+               for i in range(0, len(query_genes), run_by_batch)]
+    pool = None
+    if len(batches) > 0:
+        pool = ConnectionPool(min(workers, len(batches)), connect)
+    batch_times = []
+    failed_genes = []
+    # set when the caller stops reading, so the batches still running stop
+    stopped = threading.Event()
+
+    # the data frames of each batch are handed over through a small queue as
+    # they are ready, batches ahead of the one being read wait once theirs is
+    # full
+    def query_batch(genes, frames):
+        def hand_over(raw_df):
+            while not stopped.is_set():
+                try:
+                    frames.put(raw_df, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+            raise BatchStopped()
+        if stopped.is_set():
+            raise BatchStopped()
+        return run_gene_batch(pool, genes, hand_over, query_mode, fetch_size)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            batch_frames = [queue.Queue(FRAMES_PER_BATCH) for genes in batches]
+            futures = [executor.submit(query_batch, genes, frames)
+                       for genes, frames in zip(batches, batch_frames)]
+            i = 0
+            # results are returned in the order of the batches
+            for genes, frames, future in zip(batches, batch_frames, futures):
+                raw_dfs = []
+                num_rows = 0
+                found_genes = set()
+                for raw_df in frames_of_batch(frames, future):
+                    gene_rows = rows_by_gene(raw_df, genes)
+                    if cache is not None:
+                        cache.put_many(gene_rows)
+                    found_genes.update(gene_rows)
+                    num_rows += len(raw_df)
+                    # with a checkpoint the batch is given once it is saved
+                    if checkpoint is None:
+                        yield raw_df, None
+                    else:
+                        raw_dfs.append(raw_df)
+
+                try:
+                    batch_time = future.result()
+                except BATCH_ERRORS as e:
+                    # rows streamed before the batch failed were kept
+                    failed = [g for g in genes if g not in found_genes]
+                    msg = 'microbes online batch of {} genes failed at {}, '\
+                          'genes were not annotated: {}'.format(
+                              len(genes), dt.now(), ', '.join(failed))
+                    print('\n'.join([msg, str(e)]))
+                    with open('error-messages-microbes-online.txt', 'a') as f:
+                        f.write('\n'.join(['\n\n', msg, str(e)]))
+                    failed_genes += failed
+                    metrics.count('microbes_online.failed_genes', len(failed))
+                    i += len(genes)
+                    for raw_df in raw_dfs:
+                        yield raw_df, None
+                    continue
+
+                print("\n* Microbes_online processed {}-{} genes of {} in "
+                      "{:.2f} seconds".format(i+1, (i+len(genes)),
+                                              len(query_genes), batch_time))
+                i += len(genes)
+                batch_times.append(batch_time)
+                # rows returned per gene asked for, the joined query returns
+                # every combination of a gene's annotations
+                metrics.observe('microbes_online.batch_seconds', batch_time)
+                metrics.observe('microbes_online.rows_per_batch', num_rows)
+                metrics.observe('microbes_online.rows_per_gene',
+                                num_rows/len(genes))
+
+                if checkpoint is not None:
+                    batch_df = None
+                    if len(raw_dfs) > 0:
+                        batch_df = pd.concat(raw_dfs, ignore_index=True,
+                                             sort=False)
+                    file_name = checkpoint.save('microbes_online', genes,
+                                                batch_df)
+                    if batch_df is not None:
+                        yield batch_df, file_name
+
+                # remember genes that weren't found too
+                if cache is not None:
+                    cache.put_many({g: [] for g in genes
+                                    if g not in found_genes})
+        finally:
+            stopped.set()
+
+    if pool is not None:
+        pool.close()
+    if len(batch_times) > 0:
+        print("Microbes online batches: {}, mean {:.2f} seconds, max {:.2f} "
+              "seconds".format(len(batch_times),
+                               sum(batch_times)/len(batch_times),
+                               max(batch_times)))
+    if len(failed_genes) > 0:
+        print("Microbes online could not annotate {} genes".format(
+              len(failed_genes)))
+    if cache is not None:
+        cache.close()
+
+
+# Query a batch of genes in query_mode, returns the post-processed data
+# frames for it
+def query_gene_batch(connection, genes, query_mode='joined', fetch_size=10000):
+    if query_mode == 'streaming':
+        return (postprocess_query_df(df) for df in
+                stream_gene_batch(connection, genes, fetch_size))
+    elif query_mode == 'narrow':
+        return [postprocess_query_df(run_narrow_queries(connection, genes))]
+
+    query = make_query(genes)
+    query_result, field_names = run_query(connection, query)
+
+    # return df with all possible result combinations
+    return [postprocess_query_result(query_result, field_names)]
+
+
+# Query a batch of genes with a connection from pool, passing each data frame
+# to handle as soon as it is ready so a streaming batch is never held in
+# memory whole. The connection always goes back to the pool, one that failed
+# is replaced. A batch that fails with one of BATCH_ERRORS, like connection
+# reset by peer, is tried again up to max_retries times as long as none of it
+# was passed on yet. Returns how long the batch took.
+def run_gene_batch(pool, genes, handle, query_mode='joined', fetch_size=10000,
+                   max_retries=3):
+    for attempt in range(max_retries + 1):
+        start_time = time.time()
+        connection = None
+        num_handled = 0
+        done = False
+        try:
+            connection = pool.get()
+            for raw_df in query_gene_batch(connection, genes, query_mode,
+                                           fetch_size):
+                handle(raw_df)
+                num_handled += 1
+            done = True
+        except BATCH_ERRORS as e:
+            if attempt == max_retries or num_handled > 0:
+                raise
+            error = e
+        finally:
+            if connection is not None:
+                if done:
+                    pool.put(connection)
+                else:
+                    pool.replace(connection)
+        if done:
+            return time.time() - start_time
+        sleep_time = 2**attempt
+        print('Microbes online batch failed, trying again in {} '
+              'seconds.\n{}'.format(sleep_time, error))
+        time.sleep(sleep_time)
+
+
+# Data frames a batch puts on frames, until the batch is done
+def frames_of_batch(frames, future):
+    while True:
+        try:
+            yield frames.get(timeout=0.1)
+        except queue.Empty:
+            # a finished batch has put all of its frames
+            if future.done() and frames.empty():
+                return
+
+
+# Database connections shared by worker threads, a thread takes one with get
+# and gives it back with put. A connection that failed is closed with replace
+# and a new one is made in its place when it is next taken, so a connection
+# that can't be made right away doesn't leave the pool a connection short.
+# connect makes a new connection.
+class ConnectionPool:
+    def __init__(self, size, connect=None):
+        if connect is None:
+            connect = get_mysql_connection
+        self.connect = connect
+        self.connections = queue.Queue()
+        for i in range(size):
+            self.connections.put(connect())
+
+    def get(self):
+        connection = self.connections.get()
+        if connection is None:
+            try:
+                connection = self.connect()
+            except BaseException:
+                self.connections.put(None)
+                raise
+        return connection
+
+    def put(self, connection):
+        self.connections.put(connection)
+
+    def replace(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            # a connection that failed may not close cleanly either
+            pass
+        self.connections.put(None)
+
+    def close(self):
+        while not self.connections.empty():
+            connection = self.connections.get()
+            if connection is not None:
+                connection.close()
+
+
+# Split a post-processed result into a list of row records for each of the
+# genes asked for. Microbes online matches gene names ignoring case, so rows
+# are kept under the gene asked for whatever the case of their name. With
+# missing=True genes without results get an empty list so the miss is
+# remembered too.
+def rows_by_gene(df, genes, missing=False):
+    asked = {}
+    for g in genes:
+        asked.setdefault(g.lower(), []).append(g)
+    gene_rows = {g: [] for g in genes} if missing else {}
+    df = df.astype(object).where(df.notnull(), None)
+    for row in df.to_dict('records'):
+        row = {k: (None if v is None else str(v)) for k, v in row.items()}
+        for g in asked.get(str(row['name']).lower(), [row['name']]):
+            gene_rows.setdefault(g, []).append(row)
+    return gene_rows
+
+
 # function to read in files as lists
 def file_as_list(file_name):
     with open(file_name) as f:
@@ -58,15 +352,98 @@ def file_as_list(file_name):
     return content
 
 
+# genes of gene_file, which can also be a list of genes
+def gene_list(gene_file):
+    if isinstance(gene_file, list):
+        return gene_file
+    return file_as_list(gene_file)
+
+
 # function to generate query
-def make_query(genes):
+def make_query(genes, query=None):
     genes = ["'" + g + "'" for g in genes]
     genes = ", ".join(genes)
-    query = " ".join(file_as_list('query.txt'))
+    if query is None:
+        query = read_query()
     query = query.replace("INSERT_GENE_LIST", genes)
     return query
 
 
+# query files are only read from disk once
+@functools.lru_cache()
+def read_query(file_name='query.txt'):
+    return " ".join(file_as_list(file_name))
+
+
+# Read the queries in narrow-queries.txt, each one starts with a
+# '-- name' line. The first one finds the loci for the gene names, the rest
+# each return one kind of information for those loci.
+@functools.lru_cache()
+def read_narrow_queries(file_name=NARROW_QUERY_FILE):
+    queries = []
+    for line in file_as_list(file_name):
+        if line.startswith('--'):
+            queries.append([])
+        elif line != '':
+            queries[-1].append(line)
+    return tuple(" ".join(query) for query in queries)
+
+
+# Run each narrow query for genes and line the results up by locus
+def run_narrow_queries(connection, genes):
+    frames = []
+    for query in read_narrow_queries():
+        query_result, field_names = run_query(connection,
+                                              make_query(genes, query))
+        frames.append(pd.DataFrame(query_result, columns=field_names))
+    return zip_query_dimensions(frames[0], frames[1:])
+
+
+# Put the rows each query returned for a gene side by side instead of taking
+# every combination of them like the joined query does. Queries with fewer
+# rows for a gene repeat their rows, so every column ends up with the same
+# unique values per gene as the joined query, just in far fewer rows.
+def zip_query_dimensions(loci, dimensions, keys=['name', 'locus_id']):
+    gene_keys = loci[keys].drop_duplicates()
+    frames = [loci.copy()] + [pd.merge(gene_keys, d, how='left', on='locus_id')
+                              for d in dimensions]
+    # none of the genes were found
+    if len(gene_keys) == 0:
+        return pd.DataFrame(columns=list(dict.fromkeys(
+            c for f in frames for c in f.columns)))
+
+    # number the rows each query has for a gene
+    for f in frames:
+        f['dimension_row'] = f.groupby(keys, sort=False).cumcount()
+        f['dimension_rows'] = f.groupby(keys, sort=False)[
+            'dimension_row'].transform(len)
+
+    # each gene gets as many rows as its longest query result
+    counts = pd.concat([f[keys + ['dimension_rows']] for f in frames])
+    counts = counts.groupby(keys, sort=False)['dimension_rows'].max()
+    num_rows = pd.merge(gene_keys, counts.reset_index(), how='left',
+                        on=keys)['dimension_rows'].values
+    df = gene_keys.iloc[np.repeat(np.arange(len(gene_keys)), num_rows)]
+    df = df.reset_index(drop=True)
+    df['row'] = np.arange(len(df)) - np.repeat(np.cumsum(num_rows) - num_rows,
+                                               num_rows)
+
+    # fill row i with row i of each query, wrapping around shorter ones
+    for f in frames:
+        columns = [c for c in f.columns if c not in keys and
+                   c not in ['dimension_row', 'dimension_rows']]
+        rows = f[keys + ['dimension_rows']].drop_duplicates()
+        lined_up = pd.merge(df[keys + ['row']], rows, how='left', on=keys)
+        lined_up['dimension_row'] = lined_up['row'] % lined_up['dimension_rows']
+        lined_up = pd.merge(lined_up, f[keys + ['dimension_row'] + columns],
+                            how='left', on=keys + ['dimension_row'])
+        for c in columns:
+            df[c] = lined_up[c].values
+
+    df.drop('row', axis=1, inplace=True)
+    return df
+
+
 def get_mysql_connection():
     # catch System error 104: connection reset by peer
     success = False
@@ -90,13 +467,25 @@ def get_mysql_connection():
             print('\n'.join([msg, str(e)]))
             with open('error-messages-microbes-online.txt', 'a') as f:
                 f.write('\n'.join(['\n\n', msg, str(e)]))
-            time.sleep(sleep_time)
+            # don't wait if there won't be another try
             if num_iter >= max_connect_errors:
                 raise RuntimeError('Too many iterations for microbes\
                                     online query.')
+            time.sleep(sleep_time)
+
+
+# Connect to the local copy of the microbes online tables made with
+# local_mirror.py
+def get_mirror_connection(mirror_file=MIRROR_FILE):
+    if not os.path.exists(mirror_file):
+        raise RuntimeError('No local microbes online copy at {}, make one '
+                           'with local_mirror.py'.format(mirror_file))
+    # connections are handed between worker threads by the pool
+    return sqlite3.connect(mirror_file, check_same_thread=False)
 
 
 # Connect to the database and run query
+@timed('microbes_online.run_query')
 def run_query(connection, query):
     # Run the query
     cursor = connection.cursor()
@@ -106,6 +495,72 @@ def run_query(connection, query):
     return(result, field_names)
 
 
+# Run query with an unbuffered cursor, yielding fetch_size rows at a time
+def stream_query(connection, query, params=(), fetch_size=10000):
+    cursor = connection.cursor(buffered=False)
+    # time waiting on the database, apart from processing the rows
+    with metrics.timer('microbes_online.fetch'):
+        cursor.execute(query, params)
+        rows = cursor.fetchmany(fetch_size)
+    field_names = [i[0] for i in cursor.description]
+    while len(rows) > 0:
+        yield rows, field_names
+        with metrics.timer('microbes_online.fetch'):
+            rows = cursor.fetchmany(fetch_size)
+    cursor.close()
+
+
+# Stream query as data frames that each hold all of the rows for the genes in
+# them. The query must be ordered by gene name.
+def stream_query_by_gene(connection, query, params=(), fetch_size=10000):
+    held_back = []
+    field_names = []
+    for rows, field_names in stream_query(connection, query, params,
+                                          fetch_size):
+        name_index = field_names.index('name')
+        rows = held_back + rows
+        # rows for the last gene may continue in the next fetch
+        last_name = str(rows[-1][name_index]).lower()
+        split = len(rows)
+        while split > 0 and str(rows[split-1][name_index]).lower() == last_name:
+            split -= 1
+        held_back = rows[split:]
+        if split > 0:
+            yield pd.DataFrame(rows[:split], columns=field_names)
+    if len(held_back) > 0:
+        yield pd.DataFrame(held_back, columns=field_names)
+
+
+# Load genes into a temporary table that only this connection can see, so
+# queries can select from it instead of having the names pasted in
+def load_gene_table(connection, genes):
+    cursor = connection.cursor()
+    cursor.execute('create temporary table if not exists query_genes '
+                   '(name varchar(255) primary key)')
+    cursor.execute('delete from query_genes')
+    cursor.executemany('insert into query_genes (name) values (%s)',
+                       [(g,) for g in dict.fromkeys(genes)])
+    cursor.close()
+
+
+# Stream query.txt for genes, ordered by gene name. Genes are loaded into a
+# temporary table, or passed as query parameters if the table can't be made.
+def stream_gene_batch(connection, genes, fetch_size=10000):
+    query = read_query().strip().rstrip(';') + ' order by s1.name'
+    params = ()
+    try:
+        load_gene_table(connection, genes)
+        query = query.replace('INSERT_GENE_LIST',
+                              'select name from query_genes')
+    except MySQLError as e:
+        print('Could not load genes into a temporary table, passing them as '
+              'query parameters.\n{}'.format(e))
+        query = query.replace('INSERT_GENE_LIST',
+                              ', '.join(['%s' for g in genes]))
+        params = tuple(genes)
+    return stream_query_by_gene(connection, query, params, fetch_size)
+
+
 def extract_synonym(df, synonym):
     data = df[df['synonym_description'] == synonym][['name', 'synonym']]
     data = data.drop_duplicates()
@@ -114,10 +569,16 @@ def extract_synonym(df, synonym):
     return(df)
 
 
+@timed('microbes_online.postprocess_query_result')
 def postprocess_query_result(result, field_names):
+    df = pd.DataFrame(result, columns=field_names)
+    return postprocess_query_df(df)
+
+
+@timed('microbes_online.postprocess_query_df')
+def postprocess_query_df(df):
     print("Post-processing query output.")
     # clean up duplicate rows and write to CSV
-    df = pd.DataFrame(result, columns=field_names)
     df = extract_synonym(df, 'GI')
     df = extract_synonym(df, 'NCBI accession number')
     df = extract_synonym(df, 'NCBI GeneID')
@@ -127,8 +588,8 @@ def postprocess_query_result(result, field_names):
                         'NCBI accession number': 'ncbi_accession_number',
                         'NCBI GeneId': 'ncbi_gene_id'})
 
-    # return raw data frame, with all columns
-    return(df)
+    # return raw data frame, with all columns, repeated text as categories
+    return(compact(df))
 
 
 # Select columns in filters list and removes others
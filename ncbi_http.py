@@ -0,0 +1,279 @@
+import http.client
+import heapq
+import itertools
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# statuses that send the request somewhere else
+REDIRECTS = [301, 302, 303, 307, 308]
+
+# statuses a server sends when it wants fewer requests
+THROTTLED = [429, 503]
+
+# NCBI asks for no more than 3 requests a second without an API key
+NCBI_REQUESTS_PER_SECOND = 3
+
+# request priorities, lower goes first. Polls of running searches go ahead of
+# everything else so finished results are collected before more work is
+# started.
+POLL = 0
+DESCRIPTION = 1
+SUBMIT = 2
+PRIORITY_NAMES = {POLL: 'poll', DESCRIPTION: 'description', SUBMIT: 'submit'}
+
+
+# Token bucket shared by every thread sending requests to a host. Requests
+# that have to wait are let through by priority, then in the order they
+# arrived. A throttled response pauses all requests for a while.
+class RequestScheduler:
+    def __init__(self, rate=NCBI_REQUESTS_PER_SECOND, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.paused_until = 0
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.order = itertools.count()
+        # metrics
+        self.max_depth = 0
+        self.throttled = 0
+        self.retries = 0
+        self.waits = {}
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated)*self.rate)
+        self.updated = now
+
+    # Block until a request of priority may be sent, returns the seconds
+    # waited
+    def acquire(self, priority=SUBMIT):
+        start = time.time()
+        with self.condition:
+            entry = (priority, next(self.order))
+            heapq.heappush(self.waiting, entry)
+            self.max_depth = max(self.max_depth, len(self.waiting))
+            while True:
+                now = time.time()
+                self.refill(now)
+                if self.waiting[0] == entry and self.tokens >= 1 and \
+                        now >= self.paused_until:
+                    break
+                if self.waiting[0] != entry:
+                    # woken when the requests ahead of this one go
+                    self.condition.wait(1)
+                else:
+                    self.condition.wait(max(self.paused_until - now,
+                                            (1 - self.tokens)/self.rate))
+            heapq.heappop(self.waiting)
+            self.tokens -= 1
+            self.condition.notify_all()
+        wait_time = time.time() - start
+        with self.condition:
+            count, total, longest = self.waits.get(priority, (0, 0, 0))
+            self.waits[priority] = (count + 1, total + wait_time,
+                                    max(longest, wait_time))
+        return wait_time
+
+    # Stop sending requests for delay seconds after a throttled response
+    def pause(self, delay):
+        with self.condition:
+            self.throttled += 1
+            self.paused_until = max(self.paused_until, time.time() + delay)
+            self.tokens = 0
+            self.condition.notify_all()
+
+    # Change the rate, like when the limit is shared with other processes
+    def set_rate(self, rate, burst=None):
+        with self.condition:
+            self.refill(time.time())
+            self.rate = rate
+            self.burst = burst if burst is not None else max(1, rate)
+            self.tokens = min(self.tokens, self.burst)
+            self.condition.notify_all()
+
+    def count_retry(self):
+        with self.condition:
+            self.retries += 1
+
+    def queue_depth(self):
+        with self.condition:
+            return len(self.waiting)
+
+    def stats(self):
+        with self.condition:
+            return {'max_queue_depth': self.max_depth,
+                    'throttled': self.throttled, 'retries': self.retries,
+                    'waits': {PRIORITY_NAMES.get(priority, priority):
+                              {'requests': count,
+                               'mean_wait_seconds': round(total/count, 4),
+                               'max_wait_seconds': round(longest, 4)}
+                              for priority, (count, total, longest)
+                              in sorted(self.waits.items())}}
+
+    def summary(self):
+        with self.condition:
+            waits = ', '.join(
+                '{}: {} requests, wait {:.2f}s mean {:.2f}s max'.format(
+                    PRIORITY_NAMES.get(priority, priority), count,
+                    total/count, longest)
+                for priority, (count, total, longest)
+                in sorted(self.waits.items()))
+            return '{}; max queue {}, throttled {}, retried {}'.format(
+                waits if waits != '' else 'no requests', self.max_depth,
+                self.throttled, self.retries)
+
+
+# A thread's connection to a client's host. threading.local drops it when the
+# thread ends, which closes the connection, so threads that come and go don't
+# leave their sockets open.
+class ThreadConnection:
+    def __init__(self, client, connection):
+        self.client = client
+        self.connection = connection
+
+    def __del__(self):
+        self.client.forget(self.connection)
+        self.connection.close()
+
+
+# Makes GET requests to one host over connections that are kept open between
+# requests, so only the first request of each thread pays for connecting and
+# the TLS handshake. Each thread gets its own connection since a connection
+# can only have one request at a time, and is closed when the thread ends.
+# Errors are raised as urllib's
+# URLError and HTTPError so callers can handle them like urlopen's.
+# With a scheduler every request waits its turn there first, and throttled
+# responses or dropped connections are retried up to max_retries times,
+# backing off exponentially.
+class HttpClient:
+    def __init__(self, base_url, timeout=60, max_redirects=5, scheduler=None,
+                 max_retries=4, backoff=2):
+        parts = urllib.parse.urlsplit(base_url)
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.base_path = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.requests = 0
+        self.connects = 0
+
+    def url(self, path):
+        return '{}://{}{}'.format(self.scheme, self.host, path)
+
+    def get_connection(self):
+        thread_connection = getattr(self.local, 'connection', None)
+        if thread_connection is None:
+            if self.scheme == 'https':
+                connection = http.client.HTTPSConnection(
+                    self.host, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(
+                    self.host, timeout=self.timeout)
+            thread_connection = ThreadConnection(self, connection)
+            self.local.connection = thread_connection
+            with self.lock:
+                self.connections.append(connection)
+                self.connects += 1
+        return thread_connection.connection
+
+    # Close this thread's connection, the next request makes a new one
+    def drop_connection(self):
+        self.local.connection = None
+
+    def forget(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    # Returns the body of the response to a GET of path, which is relative
+    # to the base url
+    def get(self, path, priority=SUBMIT):
+        path = self.base_path + path
+        for redirect in range(self.max_redirects + 1):
+            status, reason, headers, body = self.retry_request(path, priority)
+            if status in REDIRECTS and headers.get('Location') is not None:
+                location = urllib.parse.urljoin(self.url(path),
+                                                headers['Location'])
+                parts = urllib.parse.urlsplit(location)
+                if parts.netloc != self.host:
+                    # not ours to keep a connection to
+                    return urllib.request.urlopen(
+                        location, timeout=self.timeout).read()
+                path = parts.path + ('?' + parts.query if parts.query else '')
+                continue
+            if status >= 400:
+                raise urllib.error.HTTPError(self.url(path), status, reason,
+                                             headers, None)
+            return body
+        raise urllib.error.URLError('Too many redirects for {}'.format(
+            self.url(path)))
+
+    # Send the request, waiting on the scheduler and retrying if the server
+    # throttles it or the connection fails
+    def retry_request(self, path, priority):
+        if self.scheduler is None:
+            return self.request(path)
+        for attempt in range(self.max_retries + 1):
+            self.scheduler.acquire(priority)
+            delay = self.backoff**attempt*random.uniform(0.8, 1.2)
+            try:
+                response = self.request(path)
+            except urllib.error.URLError as e:
+                if attempt == self.max_retries:
+                    raise
+                print('{} for {}, trying again in {:.0f} seconds'.format(
+                      e.reason, self.url(path), delay))
+                self.scheduler.count_retry()
+                time.sleep(delay)
+                continue
+            status, reason, headers, body = response
+            if status not in THROTTLED or attempt == self.max_retries:
+                return response
+            # wait as long as the server asks, if it says
+            try:
+                delay = max(delay, float(headers.get('Retry-After')))
+            except (TypeError, ValueError):
+                pass
+            print('Throttled ({} {}), pausing requests for {:.0f} '
+                  'seconds'.format(status, reason, delay))
+            self.scheduler.count_retry()
+            self.scheduler.pause(delay)
+
+    def request(self, path):
+        with self.lock:
+            self.requests += 1
+        for attempt in range(2):
+            connection = self.get_connection()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                self.drop_connection()
+                # the server may have closed a connection that sat idle, so
+                # try once more on a new one
+                if attempt == 0:
+                    continue
+                raise urllib.error.URLError(e)
+            if response.will_close:
+                self.drop_connection()
+            return response.status, response.reason, response.headers, body
+
+    def close(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for connection in connections:
+            connection.close()
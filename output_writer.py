@@ -0,0 +1,167 @@
+import pandas as pd
+import bz2
+import gzip
+import lzma
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # only needed for parquet and arrow output
+    pa = None
+
+# compressions each output format can be written with, the first is the
+# default
+COMPRESSIONS = {'csv': [None, 'gzip', 'bz2', 'xz'],
+                'parquet': ['snappy', None, 'gzip', 'brotli', 'zstd', 'lz4'],
+                'arrow': [None, 'lz4', 'zstd']}
+OUTPUT_FORMATS = list(COMPRESSIONS)
+
+CSV_OPENERS = {None: open, 'gzip': gzip.open, 'bz2': bz2.open,
+               'xz': lzma.open}
+
+
+# Raise ValueError or ImportError if output_format can't be written with
+# compression here, so a run doesn't fail only once it is done
+def check_output_format(output_format, compression=None):
+    if output_format not in COMPRESSIONS:
+        raise ValueError('Unknown output format {}, use one of {}'.format(
+            output_format, ', '.join(OUTPUT_FORMATS)))
+    if compression not in COMPRESSIONS[output_format]:
+        raise ValueError('{} output can be compressed with {}'.format(
+            output_format, ', '.join(str(c) for c in
+                                     COMPRESSIONS[output_format])))
+    if output_format != 'csv' and pa is None:
+        raise ImportError('{} output needs pyarrow, install it with: conda '
+                          'install pyarrow'.format(output_format))
+
+
+# Format and compression of an output file from its name, like
+# annotations.csv.gz or annotations.parquet
+def format_from_name(file_name):
+    name = file_name.lower()
+    for extension, compression in [('.gz', 'gzip'), ('.bz2', 'bz2'),
+                                   ('.xz', 'xz')]:
+        if name.endswith(extension):
+            return 'csv', compression
+    if name.endswith('.parquet'):
+        return 'parquet', default_compression('parquet')
+    if name.endswith('.arrow') or name.endswith('.feather'):
+        return 'arrow', default_compression('arrow')
+    return 'csv', None
+
+
+# Default compression for output_format
+def default_compression(output_format):
+    return COMPRESSIONS[output_format][0]
+
+
+# Writes the output a chunk of rows at a time so the whole output never has to
+# be in memory. Every chunk has the given columns, in order. Values are
+# written as text, missing ones as empty csv fields or nulls. csv files can
+# be compressed with gzip, bz2 or xz, parquet files are written one row group
+# per chunk and arrow files are Arrow IPC files with one record batch per
+# chunk.
+class OutputWriter:
+    def __init__(self, file_name, columns, output_format='csv',
+                 compression=None):
+        check_output_format(output_format, compression)
+        self.file_name = file_name
+        self.columns = list(columns)
+        self.output_format = output_format
+        self.compression = compression
+        self.rows = 0
+        self.genes = 0
+        self.header_written = False
+        self.file = None
+        self.writer = None
+        if output_format == 'csv':
+            self.file = CSV_OPENERS[compression](file_name, 'wt')
+        else:
+            self.schema = pa.schema([(c, pa.string()) for c in self.columns])
+            if output_format == 'parquet':
+                self.writer = pq.ParquetWriter(file_name, self.schema,
+                                               compression=compression)
+            else:
+                self.file = pa.OSFile(file_name, 'wb')
+                if compression is None:
+                    self.writer = pa.ipc.new_file(self.file, self.schema)
+                else:
+                    self.writer = pa.ipc.new_file(
+                        self.file, self.schema,
+                        options=pa.ipc.IpcWriteOptions(
+                            compression=compression))
+
+    def write(self, df):
+        df = df.reindex(columns=self.columns)
+        if self.output_format == 'csv':
+            df.to_csv(self.file, index=False, header=not self.header_written)
+            self.header_written = True
+        else:
+            table = pa.Table.from_pandas(as_text(df), schema=self.schema,
+                                         preserve_index=False)
+            self.writer.write_table(table)
+        self.rows += len(df)
+        self.genes += df['name'].nunique()
+
+    def close(self):
+        # an output without rows still gets its header
+        if self.output_format == 'csv' and not self.header_written:
+            self.write(pd.DataFrame(columns=self.columns))
+        if self.writer is not None:
+            self.writer.close()
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+# Text for every value that isn't missing, None for the rest
+def as_text(df):
+    df = df.astype(object)
+    return df.where(df.isnull(), df.astype(str)).where(df.notnull(), None)
+
+
+# Read back an output file written by OutputWriter chunk_rows rows at a time,
+# with text values and the missing ones as None. csv files are read in
+# chunks, parquet and arrow files a row group or record batch at a time.
+def read_output(file_name, output_format='csv', columns=None,
+                chunk_rows=100000):
+    check_output_format(output_format, default_compression(output_format))
+    if output_format == 'csv':
+        # blanks were written as empty fields, keep them as empty strings
+        for df in pd.read_csv(file_name, dtype=str, usecols=columns,
+                              keep_default_na=False, chunksize=chunk_rows):
+            yield df
+    elif output_format == 'parquet':
+        parquet_file = pq.ParquetFile(file_name)
+        for i in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(i, columns=columns).to_pandas()
+    else:
+        with pa.memory_map(file_name) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                df = reader.get_batch(i).to_pandas()
+                if columns is not None:
+                    df = df[columns]
+                yield df
+
+
+# Regroup chunks of output rows so each gene's rows are in one chunk, a gene
+# cut off at the end of a chunk is moved to the next one
+def whole_genes(chunks):
+    rest = None
+    for df in chunks:
+        if rest is not None:
+            df = pd.concat([rest, df], ignore_index=True)
+        if len(df) == 0:
+            continue
+        last_gene = df['name'] == df['name'].iloc[-1]
+        rest = df[last_gene]
+        if not last_gene.all():
+            yield df[~last_gene]
+    if rest is not None and len(rest) > 0:
+        yield rest
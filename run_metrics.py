@@ -0,0 +1,188 @@
+import collections
+import contextlib
+import cProfile
+import datetime as dt
+import functools
+import io
+import json
+import pstats
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+
+# Timers, counters and per-batch values collected while a run goes, from any
+# thread. timers add up how long something took and how often, counters add
+# up numbers like cache hits, values keep the count, total, min and max of
+# observations of something like the rows in a batch, and the last window of
+# them, so a long running service doesn't keep every one.
+class RunMetrics:
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.timers = {}
+            self.counters = {}
+            self.values = {}
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            calls, total, longest = self.timers.get(name, (0, 0, 0))
+            self.timers[name] = (calls + 1, total + seconds,
+                                 max(longest, seconds))
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start_time)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.values:
+                self.values[name] = [0, 0, value, value,
+                                     collections.deque(maxlen=self.window)]
+            summary = self.values[name]
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = min(summary[2], value)
+            summary[3] = max(summary[3], value)
+            summary[4].append(value)
+
+    def report(self):
+        with self.lock:
+            timers = {name: {'calls': calls, 'seconds': round(total, 4),
+                             'mean_seconds': round(total/calls, 4),
+                             'max_seconds': round(longest, 4)}
+                      for name, (calls, total, longest)
+                      in sorted(self.timers.items())}
+            values = {name: {'count': count, 'total': total,
+                             'mean': total/count, 'min': smallest,
+                             'max': largest,
+                             'recent_median': statistics.median(recent)}
+                      for name, (count, total, smallest, largest, recent)
+                      in sorted(self.values.items())}
+            counters = dict(sorted(self.counters.items()))
+        return {'run_seconds': round(time.time() - self.started, 4),
+                'timers': timers, 'counters': counters, 'values': values,
+                'peak_memory_mb': peak_memory_mb()}
+
+    # Write the report and anything in extra to file_name as json
+    def write_report(self, file_name, extra={}):
+        report = {'finished': dt.datetime.now().isoformat()}
+        report.update(self.report())
+        report.update(extra)
+        with open(file_name, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        print('Run report written to {}'.format(file_name))
+
+
+# metrics for everything run by this process
+metrics = RunMetrics()
+
+
+# Decorator adding the time of every call of the function to timer name
+def timed(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Largest resident size of this process so far, in MB
+def peak_memory_mb():
+    if resource is None:
+        return None
+    # kilobytes on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 1)
+
+
+# Optional profiling of a whole run. mode 'cprofile' records where time is
+# spent, 'tracemalloc' where memory is allocated and 'all' does both. stop
+# writes the cProfile stats to file_prefix.prof and returns a summary of the
+# top entries for the run report.
+# cProfile only sees the thread it is enabled in, so every thread started
+# while profiling, like the worker threads, gets a profile of its own and
+# they are merged in stop. Threads started before start are not profiled.
+class Profiler:
+    def __init__(self, mode=None, top=25):
+        self.mode = mode
+        self.top = top
+        self.profile = None
+        self.thread_profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.mode in ['tracemalloc', 'all']:
+            tracemalloc.start()
+        if self.mode in ['cprofile', 'all']:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            threading.setprofile(self.profile_thread)
+
+    # The profile function of each new thread, its first call swaps itself
+    # for a profile of the thread
+    def profile_thread(self, frame, event, arg):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # from python 3.12 one profile sees every thread and a second
+            # can't be enabled
+            sys.setprofile(None)
+            return
+        with self.lock:
+            self.thread_profiles.append(profile)
+
+    def stop(self, file_prefix):
+        summary = {}
+        if self.profile is not None:
+            threading.setprofile(None)
+            self.profile.disable()
+            text = io.StringIO()
+            stats = pstats.Stats(self.profile, stream=text)
+            with self.lock:
+                thread_profiles = self.thread_profiles
+                self.thread_profiles = []
+            for profile in thread_profiles:
+                try:
+                    stats.add(profile)
+                except TypeError:
+                    # a thread that made no calls has no stats
+                    pass
+            stats.dump_stats(file_prefix + '.prof')
+            stats.sort_stats('cumulative').print_stats(self.top)
+            summary['cprofile'] = {'stats_file': file_prefix + '.prof',
+                                   'threads': len(thread_profiles) + 1,
+                                   'top_cumulative': text.getvalue()}
+            print('cProfile stats written to {}.prof'.format(file_prefix))
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            summary['tracemalloc'] = {
+                'current_mb': round(current/2**20, 1),
+                'peak_mb': round(peak/2**20, 1),
+                'top_lines': [str(stat) for stat in
+                              snapshot.statistics('lineno')[:self.top]]}
+        return summary
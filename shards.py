@@ -0,0 +1,269 @@
+import driver
+import microbes_online as mo
+from annotation_cache import DAY
+from checkpoint import input_hash
+from output_writer import (OutputWriter, OUTPUT_FORMATS, check_output_format,
+                           default_compression, format_from_name, read_output,
+                           whole_genes)
+from ncbi_http import NCBI_REQUESTS_PER_SECOND
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+# where shard outputs, reports and logs are kept
+SHARD_DIRECTORY = 'tmp/shards'
+
+# finished shards older than this are run again, so a merge doesn't pick up
+# annotations much older than the cache would give
+SHARD_MAX_AGE = 30*DAY
+
+# file extension of the shard outputs of each format, shards are not
+# compressed since they are only read back once
+SHARD_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+# lines of a shard's driver.py output that are shown as its progress, the
+# rest only go to its log file
+PROGRESS_LINE = re.compile(r'^(\* |Shard |Microbes online cache|'
+                           r'Previous output|Reshape and write|'
+                           r'Total runtime)')
+
+
+# Output file of shard index (from 0) of count. The name has a hash of the
+# shard's genes and the options passed on to driver.py, so a shard is only
+# reused for the same genes run the same way.
+def shard_file(genes, index, count, output_format, directory=SHARD_DIRECTORY,
+               driver_args=[]):
+    shard_hash = input_hash({'genes': driver.shard_genes(genes, index, count),
+                             'driver_args': list(driver_args)})
+    return os.path.join(directory, 'shard-{:03d}-of-{:03d}-{}{}'.format(
+        index + 1, count, shard_hash, SHARD_EXTENSIONS[output_format]))
+
+
+# A shard is done once driver.py has written its report, which happens
+# after the output is complete, and it isn't older than max_age seconds
+def shard_done(file_name, max_age=SHARD_MAX_AGE):
+    report_file = file_name + '.report.json'
+    return os.path.exists(file_name) and os.path.exists(report_file) and \
+        time.time() - os.path.getmtime(report_file) < max_age
+
+
+# Runs driver.py for one shard in its own process, writing everything it
+# prints to a log file next to the shard output and showing its progress
+class ShardProcess:
+    def __init__(self, gene_file, genes, index, count, output_format,
+                 ncbi_rate, driver_args=[], directory=SHARD_DIRECTORY):
+        self.index = index
+        self.count = count
+        self.file_name = shard_file(genes, index, count, output_format,
+                                    directory, driver_args)
+        self.log_file = self.file_name + '.log'
+        self.name = '{}/{}'.format(index + 1, count)
+        # a report left by an unfinished earlier run would mark it done
+        if os.path.exists(self.file_name + '.report.json'):
+            os.remove(self.file_name + '.report.json')
+        command = [sys.executable,
+                   os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'driver.py'),
+                   gene_file, self.file_name, '--shard', self.name,
+                   '--format', output_format, '--ncbi-rate', str(ncbi_rate)]
+        if output_format == 'csv':
+            command += ['--compression', 'none']
+        self.start_time = time.time()
+        self.process = subprocess.Popen(command + list(driver_args),
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        universal_newlines=True, bufsize=1)
+        self.reader = threading.Thread(target=self.read_output, daemon=True)
+        self.reader.start()
+
+    def read_output(self):
+        with open(self.log_file, 'w') as log:
+            for line in self.process.stdout:
+                log.write(line)
+                if PROGRESS_LINE.match(line.strip()):
+                    print('[shard {}] {}'.format(self.name, line.strip()),
+                          flush=True)
+
+    # Wait for the shard to finish, returns True if it succeeded
+    def wait(self):
+        return_code = self.process.wait()
+        self.reader.join()
+        seconds = time.time() - self.start_time
+        if return_code != 0:
+            print('Shard {} failed after {:.1f} sec, see {}'.format(
+                  self.name, seconds, self.log_file), flush=True)
+            return False
+        print('Shard {} finished in {:.1f} sec'.format(self.name, seconds),
+              flush=True)
+        return True
+
+
+# Run the shards of gene_file given by numbers (from 0, all of them by
+# default) that aren't done yet, up to processes at a time. The NCBI request
+# rate is split between the processes. Returns the shards that failed.
+def run_shards(gene_file, count, output_format='csv', numbers=None,
+               processes=None, ncbi_rate=NCBI_REQUESTS_PER_SECOND,
+               driver_args=[], directory=SHARD_DIRECTORY):
+    genes = mo.file_as_list(gene_file)
+    if numbers is None:
+        numbers = range(count)
+    os.makedirs(directory, exist_ok=True)
+    todo = []
+    for index in numbers:
+        if shard_done(shard_file(genes, index, count, output_format,
+                                 directory, driver_args)):
+            print('Shard {}/{} already done, reusing it'.format(index + 1,
+                                                                count))
+        else:
+            todo.append(index)
+    if len(todo) == 0:
+        return []
+    if processes is None:
+        processes = len(todo)
+    processes = max(1, min(processes, len(todo)))
+    print('Running {} shards of {} genes, {} at a time'.format(
+          len(todo), len(genes), processes), flush=True)
+
+    failed = []
+    running = []
+    while len(todo) > 0 or len(running) > 0:
+        while len(todo) > 0 and len(running) < processes:
+            running.append(ShardProcess(gene_file, genes, todo.pop(0), count,
+                                        output_format, ncbi_rate/processes,
+                                        driver_args, directory))
+        # a finished shard makes room for the next one
+        finished = [shard for shard in running
+                    if shard.process.poll() is not None]
+        if len(finished) == 0:
+            time.sleep(0.5)
+        for shard in finished:
+            running.remove(shard)
+            if not shard.wait():
+                failed.append(shard.index)
+    return sorted(failed)
+
+
+# Join the shard outputs of gene_file in order into output_file, a chunk of
+# whole genes at a time. Every shard has to be done. Writes a report with
+# each shard's genes, rows and run time. Both are written to files of this
+# process first and moved into place once complete, so machines merging at
+# the same time can't leave a mix of their outputs.
+def merge_shards(gene_file, output_file, count, output_format='csv',
+                 compression=None, shard_format='csv',
+                 directory=SHARD_DIRECTORY, driver_args=[]):
+    start_time = time.time()
+    genes = mo.file_as_list(gene_file)
+    files = [shard_file(genes, index, count, shard_format, directory,
+                        driver_args)
+             for index in range(count)]
+    missing = [str(index + 1) for index, file_name in enumerate(files)
+               if not shard_done(file_name)]
+    if len(missing) > 0:
+        raise RuntimeError('shards {} of {} are not done'.format(
+            ', '.join(missing), count))
+
+    shards = []
+    partial_file = '{}.partial.{}'.format(output_file, os.getpid())
+    report_file = output_file + '.report.json'
+    partial_report = '{}.partial.{}'.format(report_file, os.getpid())
+    try:
+        with OutputWriter(partial_file, driver.OUTPUT_FIELDS, output_format,
+                          compression) as writer:
+            for index, file_name in enumerate(files):
+                rows = writer.rows
+                for df in whole_genes(read_output(file_name, shard_format)):
+                    writer.write(df)
+                with open(file_name + '.report.json') as f:
+                    report = json.load(f)
+                shards.append({'shard': '{}/{}'.format(index + 1, count),
+                               'file': file_name, 'genes': report['genes'],
+                               'output_rows': writer.rows - rows,
+                               'run_seconds': report['run_seconds']})
+        merge_time = time.time() - start_time
+        with open(partial_report, 'w') as f:
+            json.dump({'genes': len(set(genes)), 'output_rows': writer.rows,
+                       'output_genes': int(writer.genes),
+                       'output_format': output_format,
+                       'compression': compression,
+                       'merge_seconds': round(merge_time, 4),
+                       'shards': shards}, f, indent=2)
+        os.replace(partial_file, output_file)
+        os.replace(partial_report, report_file)
+    finally:
+        for file_name in [partial_file, partial_report]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+    print('Merged {} shards, {} rows: {:.4f} sec'.format(count, writer.rows,
+                                                         merge_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Split a gene list into shards, annotate them with '
+                    'driver.py in separate processes and join their outputs. '
+                    'Other options are passed on to driver.py.')
+    parser.add_argument('command', choices=['run', 'merge'],
+                        help='run: annotate the shards that are not done '
+                             'and merge them once all are; merge: only '
+                             'merge')
+    parser.add_argument('gene_file', help='file with one gene name per line')
+    parser.add_argument('output_file', help='file to write to')
+    parser.add_argument('--shards', type=int, required=True,
+                        help='number of shards to split the genes into')
+    parser.add_argument('--only', type=int, nargs='+',
+                        help='run only these shards (from 1), to share them '
+                             'between machines using the same directory')
+    parser.add_argument('--processes', type=int,
+                        help='shards to run at a time, default all')
+    parser.add_argument('--ncbi-rate', type=float,
+                        default=NCBI_REQUESTS_PER_SECOND,
+                        help='NCBI requests per second shared by all the '
+                             'processes')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS,
+                        help='output format, by default from the output '
+                             'file name like driver.py')
+    parser.add_argument('--compression')
+    parser.add_argument('--directory', default=SHARD_DIRECTORY,
+                        help='where shard outputs are kept')
+    args, driver_args = parser.parse_known_args()
+    if args.shards < 1:
+        parser.error('--shards must be at least 1')
+    if args.only is not None and \
+            any(n < 1 or n > args.shards for n in args.only):
+        parser.error('--only takes shard numbers from 1 to {}'.format(
+                     args.shards))
+    output_format, compression = format_from_name(args.output_file)
+    if args.format is not None and args.format != output_format:
+        output_format = args.format
+        compression = default_compression(output_format)
+    if args.compression is not None:
+        compression = args.compression
+        if compression == 'none':
+            compression = None
+    try:
+        check_output_format(output_format, compression)
+    except (ValueError, ImportError) as e:
+        parser.error(str(e))
+
+    if args.command == 'run':
+        numbers = None
+        if args.only is not None:
+            numbers = [n - 1 for n in args.only]
+        failed = run_shards(args.gene_file, args.shards, output_format,
+                            numbers, args.processes, args.ncbi_rate,
+                            driver_args, args.directory)
+        if len(failed) > 0:
+            sys.exit('Shards {} failed'.format(
+                ', '.join(str(n + 1) for n in failed)))
+    try:
+        merge_shards(args.gene_file, args.output_file, args.shards,
+                     output_format, compression, output_format,
+                     args.directory, driver_args)
+    except RuntimeError as e:
+        # other machines may still be running the rest
+        sys.exit('Not merging yet, {}'.format(e))
@@ -0,0 +1,50 @@
+import os
+import runpy
+import shutil
+import sys
+
+import pytest
+
+# the modules are at the top of the repository
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+import benchmark  # noqa: E402
+import conserved_domains as cdd  # noqa: E402
+
+
+# Runs driver.py in this process with args, so it uses the stand-ins
+def driver_run(*args):
+    argv = sys.argv
+    sys.argv = ['driver.py'] + [str(a) for a in args]
+    try:
+        runpy.run_path(os.path.join(REPOSITORY, 'driver.py'),
+                       run_name='__main__')
+    finally:
+        sys.argv = argv
+
+
+@pytest.fixture
+def run_driver():
+    return driver_run
+
+
+# A run directory in tmp_path with the query files, a cddid index and the
+# benchmark's stand-ins for NCBI and microbes online
+@pytest.fixture
+def stand_ins(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for file_name in ['query.txt', 'narrow-queries.txt']:
+        shutil.copy(os.path.join(REPOSITORY, file_name), file_name)
+    os.makedirs('cache')
+    benchmark.make_cdd_index(cdd.CDD_INDEX_FILE)
+    server = benchmark.start_ncbi_stub()
+    client, scheduler = cdd.ncbi_client, cdd.ncbi_scheduler
+    cdd.set_ncbi_url('http://127.0.0.1:{}'.format(server.server_port),
+                     rate=10000)
+    with benchmark.fake_microbes_online(benchmark.FakeMicrobesOnline):
+        yield server
+    cdd.ncbi_client.close()
+    cdd.ncbi_client, cdd.ncbi_scheduler = client, scheduler
+    server.shutdown()
+    server.server_close()
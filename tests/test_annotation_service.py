@@ -0,0 +1,43 @@
+import threading
+from concurrent.futures import TimeoutError
+
+import pytest
+
+from annotation_service import Coalescer
+
+
+def test_lookups_are_batched_together():
+    calls = []
+
+    def lookup(items):
+        calls.append(items)
+        return {i: [i.upper()] for i in items}
+
+    coalescer = Coalescer(lookup, max_batch=10, max_wait=0.2)
+    results = {}
+
+    def request(items):
+        results.update(coalescer.lookup(items, timeout=5))
+
+    threads = [threading.Thread(target=request, args=(items,))
+               for items in [['a', 'b'], ['b', 'c']]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {'a': ['A'], 'b': ['B'], 'c': ['C']}
+    assert len(calls) == 1
+    assert sorted(calls[0]) == ['a', 'b', 'c']
+
+
+def test_lookup_times_out():
+    release = threading.Event()
+
+    def lookup(items):
+        release.wait(5)
+        return {}
+
+    coalescer = Coalescer(lookup, max_wait=0)
+    with pytest.raises(TimeoutError):
+        coalescer.lookup(['a'], timeout=0.1)
+    release.set()
@@ -0,0 +1,83 @@
+import gzip
+import http.server
+import os
+import queue
+import threading
+import time
+
+import conserved_domains as cdd
+
+
+def test_search_stats_are_bounded():
+    stats = cdd.CddSearchStats(history=10)
+    for i in range(1000):
+        stats.record(10, 3, 30 + i % 2)
+    stats.record(10, 40, 500, timed_out=True)
+    assert len(stats.recent) == 10
+    assert stats.expected_latency(20) == 62
+    summary = stats.summary()
+    assert summary['searches'] == 1001
+    assert summary['timed_out'] == 1
+    assert summary['polls'] == 3040
+    assert summary['max_polls'] == 40
+    # the timed out search is not counted as one that finished
+    assert summary['latency_histogram']['160-inf'] == 0
+    assert summary['latency_histogram']['20-40'] == 1000
+    assert summary['latency_histogram']['timed out'] == 1
+
+
+# Serves the gzipped cddid table the server holds, like NCBI's ftp site
+class CddidHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = gzip.compress(self.server.table.encode('utf-8'))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_index_is_built_from_a_download(tmp_path):
+    server = http.server.HTTPServer(('127.0.0.1', 0), CddidHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/cddid.tbl.gz'.format(server.server_port)
+    index_file = os.path.join(str(tmp_path), 'cddid.sqlite')
+    try:
+        server.table = '1\tcd00001\tshort\tfirst domain\t100\n' \
+                       '2\tpfam00002\tother\tsecond domain\t80\n'
+        cdd.build_cdd_index(url, index_file)
+        df = cdd.lookup_cdd_index(['cd00001', 'pfam00002'], index_file)
+        assert dict(zip(df['accession'], df['cdd_description'])) == {
+            'cd00001': 'first domain', 'pfam00002': 'second domain'}
+
+        # building again replaces the index
+        server.table = '3\tcd00003\tnew\tthird domain\t90\n'
+        cdd.build_cdd_index(url, index_file)
+        df = cdd.lookup_cdd_index(['cd00001', 'cd00003'], index_file)
+        assert list(df['accession']) == ['cd00003']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# A batch put on the queue while a search is running is submitted as it
+# arrives, not when the running search is next checked
+def test_queued_batches_are_submitted_as_they_arrive(stand_ins):
+    stats = cdd.CddSearchStats()
+    # searches have taken 4 seconds a GI, so the first check is after 3
+    stats.record(1, 1, 4)
+    batches = queue.Queue()
+    batches.put(['101'])
+
+    def add_batch():
+        time.sleep(0.3)
+        batches.put(['202'])
+        batches.put(None)
+
+    threading.Thread(target=add_batch).start()
+    results = list(cdd.query_ncbi_cdd_batches(batches, stats=stats))
+    assert sorted(gis for gis, df in results) == [['101'], ['202']]
+    submitted = sorted(start for start, gis in stand_ins.searches.values())
+    assert submitted[1] - submitted[0] < 1
@@ -0,0 +1,66 @@
+import os
+
+import pandas as pd
+import pytest
+
+import benchmark
+from output_writer import format_from_name, read_output
+
+
+def write_genes(file_name, genes):
+    with open(file_name, 'w') as f:
+        f.write('\n'.join(genes) + '\n')
+
+
+# The batches kept to resume a run are removed once its output is written
+def test_finished_run_leaves_no_batches(stand_ins, run_driver):
+    write_genes('genes.txt', benchmark.make_genes(20))
+    run_driver('genes.txt', 'out.csv', '--compression', 'none')
+    assert os.path.exists('out.csv')
+    assert os.listdir('tmp/runs') == []
+
+
+# Running the stages at the same time gives the same output as one after
+# the other, with batches small enough that several go through the queues
+def test_pipelined_matches_stages_in_turn(stand_ins, run_driver):
+    write_genes('genes.txt', benchmark.make_genes(120))
+    run_driver('genes.txt', 'stages.csv', '--compression', 'none',
+               '--batch-size', '25', '--workers', '2')
+    os.remove('cache/annotation-cache.sqlite')
+    run_driver('genes.txt', 'pipelined.csv', '--compression', 'none',
+               '--batch-size', '25', '--workers', '2', '--pipelined')
+    with open('stages.csv') as stages, open('pipelined.csv') as pipelined:
+        assert pipelined.read() == stages.read()
+
+
+def read_all(file_name):
+    output_format = format_from_name(file_name)[0]
+    df = pd.concat(read_output(file_name, output_format), ignore_index=True)
+    return df.astype(object).where(df.notnull(), '')
+
+
+# An update of an earlier output, in the same or another format or in place,
+# matches a full run: genes no longer in the list are dropped, kept genes
+# are copied with their interpro links made for the new format and added
+# genes are annotated
+@pytest.mark.parametrize('previous,output', [
+    ('old.csv', 'new.csv'), ('old.parquet', 'new.parquet'),
+    ('old.parquet', 'new.csv'), ('old.csv', 'new.parquet'),
+    ('old.csv', 'old.csv')])
+def test_previous_output_is_updated(stand_ins, run_driver, previous, output):
+    if previous.endswith('.parquet') or output.endswith('.parquet'):
+        pytest.importorskip('pyarrow')
+    genes = benchmark.make_genes(70)
+    write_genes('old.txt', genes[:40] + genes[60:])
+    write_genes('new.txt', genes[:60])
+    run_driver('new.txt', 'full' + os.path.splitext(output)[1])
+    run_driver('old.txt', previous)
+    run_driver('new.txt', output, '--previous', previous)
+
+    df = read_all(output)
+    assert df.equals(read_all('full' + os.path.splitext(output)[1]))
+    assert list(df['name'].unique()) == genes[:60]
+    if output.endswith('.csv'):
+        assert df['ipr_link'].str.startswith('=HYPERLINK').any()
+    else:
+        assert df['ipr_link'].str.startswith('https://').any()
@@ -0,0 +1,14 @@
+import io
+import local_mirror
+
+
+def test_dump_rows_are_unescaped():
+    dump = io.StringIO('1\tplain\t\\N\n'
+                       '2\ttab\\\there\tback\\\\slash\n'
+                       '3\tnew\\\nline\t\\\\N\n'
+                       '4\t\\0\\t\\n\\Z\t\n')
+    assert list(local_mirror.dump_rows(dump)) == [
+        ['1', 'plain', None],
+        ['2', 'tab\there', 'back\\slash'],
+        ['3', 'new\nline', '\\N'],
+        ['4', '\0\t\n\x1a', '']]
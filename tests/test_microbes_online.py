@@ -0,0 +1,48 @@
+import microbes_online as mo
+import pandas as pd
+
+
+def test_rows_by_gene_ignores_case():
+    df = pd.DataFrame({'name': ['B0001', 'B0001', 'b0002'],
+                       'gi': ['1', '2', None]})
+    gene_rows = mo.rows_by_gene(df, ['b0001', 'b0002', 'b0003'],
+                                missing=True)
+    assert [row['gi'] for row in gene_rows['b0001']] == ['1', '2']
+    assert gene_rows['b0002'] == [{'name': 'b0002', 'gi': None}]
+    assert gene_rows['b0003'] == []
+    assert 'B0001' not in gene_rows
+
+
+class FakeConnection:
+    def close(self):
+        pass
+
+
+def test_pool_keeps_connections_after_errors(monkeypatch):
+    connects = []
+
+    def connect():
+        connects.append(1)
+        if len(connects) == 2:
+            raise RuntimeError('could not connect')
+        return FakeConnection()
+
+    def query_gene_batch(connection, genes, query_mode, fetch_size):
+        if genes == ['bad']:
+            raise ValueError('not a database error')
+        return [pd.DataFrame({'name': genes})]
+
+    monkeypatch.setattr(mo, 'query_gene_batch', query_gene_batch)
+    pool = mo.ConnectionPool(1, connect)
+    try:
+        mo.run_gene_batch(pool, ['bad'], [].append)
+    except ValueError:
+        pass
+    # the failed connection is replaced, the first new one can't be made
+    # and the batch is tried again with the next
+    monkeypatch.setattr(mo.time, 'sleep', lambda seconds: None)
+    raw_dfs = []
+    mo.run_gene_batch(pool, ['b0001'], raw_dfs.append)
+    assert list(raw_dfs[0]['name']) == ['b0001']
+    assert len(connects) == 3
+    assert pool.connections.qsize() == 1
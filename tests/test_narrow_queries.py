@@ -0,0 +1,102 @@
+import os
+import random
+
+import local_mirror
+import microbes_online as mo
+
+# columns of the synthetic microbes online tables, enough for query.txt and
+# narrow-queries.txt
+MIRROR_TABLES = {
+    'Synonym': ['name', 'locusId', 'type'],
+    'SynonymType': ['type', 'description'],
+    'Description': ['locusId', 'description', 'taxonomyId'],
+    'COG': ['locusId', 'cogInfoId'],
+    'COGInfo': ['cogInfoId', 'description', 'funCode', 'geneName'],
+    'COGFun': ['funCode', 'description', 'funGroup'],
+    'Locus2Domain': ['locusId', 'domainId'],
+    'TIGRInfo': ['tigrId', 'roleId'],
+    'TIGRroles': ['roleId', 'description'],
+    'Locus2Ipr': ['locusId', 'iprId'],
+    'IPRInfo': ['iprId', 'iprName'],
+    'Locus2Go': ['locusId', 'goID', 'evidence'],
+    'term': ['id', 'acc', 'name', 'term_type'],
+    'Taxonomy': ['taxonomyId', 'name'],
+    'Locus': ['locusId', 'type'],
+    'LocusType': ['type'],
+    'AASeq': ['locusId']}
+
+
+# A local mirror of genes with one to three GO terms, interpro domains, tigr
+# roles and aliases each, some with none
+def make_mirror(mirror_file, genes):
+    rows = {table: [] for table in MIRROR_TABLES}
+    rows['SynonymType'] = [['1', 'locus tag'], ['2', 'GI'],
+                           ['3', 'NCBI accession number'],
+                           ['4', 'NCBI GeneID'], ['5', 'alias']]
+    rows['COGFun'] = [['C', 'Energy production', 'Metabolism'],
+                      ['J', 'Translation', 'Information']]
+    rows['Taxonomy'] = [['511145', 'Escherichia coli K-12']]
+    rows['LocusType'] = [['1']]
+    for t in range(6):
+        rows['COGInfo'].append([str(t), 'cog {}'.format(t), 'CJ'[t % 2],
+                                'gen{}'.format(t)])
+        rows['TIGRInfo'].append(['TIGR{}'.format(t), str(t % 4)])
+        rows['IPRInfo'].append(['IPR{:06d}'.format(t), 'domain {}'.format(t)])
+        rows['term'].append([str(t), 'GO:{:07d}'.format(t), 'term {}'.format(t),
+                             ['process', 'function'][t % 2]])
+    rows['TIGRroles'] = [[str(r), 'role {}'.format(r)] for r in range(4)]
+
+    randoms = random.Random(1)
+    for locus, gene in enumerate(genes):
+        locus = str(locus)
+        rows['Synonym'] += [[gene, locus, '1'], [str(1000 + int(locus)),
+                                                 locus, '2'],
+                            ['NP_{}'.format(locus), locus, '3'],
+                            [str(9000 + int(locus)), locus, '4']]
+        rows['Synonym'] += [['{}-alias{}'.format(gene, a), locus, '5']
+                            for a in range(randoms.randint(0, 2))]
+        rows['Description'].append([locus, 'gene {}'.format(gene), '511145'])
+        rows['COG'].append([locus, str(randoms.randint(0, 5))])
+        rows['Locus'].append([locus, '1'])
+        rows['AASeq'].append([locus])
+        for table, values in [('Locus2Domain', 'TIGR{}'),
+                              ('Locus2Ipr', 'IPR{:06d}')]:
+            for v in randoms.sample(range(6), randoms.randint(0, 3)):
+                rows[table].append([locus, values.format(v)])
+        for v in randoms.sample(range(6), randoms.randint(0, 3)):
+            rows['Locus2Go'].append([locus, str(v), 'IEA'])
+
+    mirror = local_mirror.get_mirror(mirror_file)
+    for table, columns in MIRROR_TABLES.items():
+        local_mirror.create_table(mirror, table, columns)
+        local_mirror.insert_rows(mirror, table, columns, rows[table])
+    mirror.commit()
+    local_mirror.create_indexes(mirror)
+    mirror.close()
+
+
+# A batch where none of the genes are found is empty, not an error
+def test_narrow_finds_nothing_like_joined(stand_ins):
+    make_mirror('mirror.sqlite', ['b0001'])
+    connection = mo.get_mirror_connection('mirror.sqlite')
+    for query_mode in ['joined', 'narrow']:
+        raw_dfs = mo.query_gene_batch(connection, ['nope1', 'nope2'],
+                                      query_mode)
+        assert sum(len(raw_df) for raw_df in raw_dfs) == 0
+    connection.close()
+
+
+# The narrow queries give the same output as the joined one
+def test_narrow_output_matches_joined(stand_ins, run_driver):
+    genes = ['b{:04d}'.format(i) for i in range(1, 41)]
+    make_mirror('mirror.sqlite', genes)
+    with open('genes.txt', 'w') as f:
+        f.write('\n'.join(genes + ['nope1']) + '\n')
+    for query_mode in ['joined', 'narrow']:
+        run_driver('genes.txt', query_mode + '.csv', '--compression', 'none',
+                   '--backend', 'local', '--mirror-file', 'mirror.sqlite',
+                   '--query-mode', query_mode)
+        # nothing is taken from the cache the other mode filled
+        os.remove('cache/annotation-cache.sqlite')
+    with open('joined.csv') as joined, open('narrow.csv') as narrow:
+        assert narrow.read() == joined.read()
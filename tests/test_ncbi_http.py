@@ -0,0 +1,84 @@
+import http.server
+import threading
+import urllib.error
+
+import pytest
+
+from ncbi_http import HttpClient, RequestScheduler
+
+
+# Answers every GET with its path, keeping connections open. /base/missing is
+# not found and /base/throttled is refused with 429 the first time.
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        status = 200
+        if self.path == '/base/missing':
+            status = 404
+        elif self.path == '/base/throttled' and not self.server.throttled:
+            self.server.throttled = True
+            status = 429
+        body = self.path.encode('utf-8')
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.throttled = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def base_url(server):
+    return 'http://127.0.0.1:{}/base'.format(server.server_port)
+
+
+def test_requests_share_a_connection(server):
+    client = HttpClient(base_url(server))
+    assert [client.get('/page/{}'.format(i)) for i in range(5)] == \
+        [b'/base/page/' + str(i).encode('utf-8') for i in range(5)]
+    assert client.connects == 1
+    assert server.connections == 1
+    with pytest.raises(urllib.error.HTTPError):
+        client.get('/missing')
+    client.close()
+
+
+def test_connections_close_when_threads_end(server):
+    client = HttpClient(base_url(server))
+    for i in range(10):
+        thread = threading.Thread(target=client.get, args=('/page',))
+        thread.start()
+        thread.join()
+    assert client.connects == 10
+    assert client.connections == []
+
+
+def test_throttled_requests_are_retried(server):
+    scheduler = RequestScheduler(rate=1000)
+    client = HttpClient(base_url(server), scheduler=scheduler, backoff=0)
+    assert client.get('/throttled') == b'/base/throttled'
+    assert scheduler.throttled == 1
+    assert scheduler.retries == 1
+    client.close()
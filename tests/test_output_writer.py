@@ -0,0 +1,50 @@
+import pandas as pd
+import pytest
+
+from output_writer import OutputWriter, read_output, whole_genes
+
+COLUMNS = ['name', 'go_id', 'ipr_link']
+
+CHUNKS = [pd.DataFrame({'name': ['b0001', 'b0001', 'b0002'],
+                        'go_id': ['GO:1', 'GO:2', ''],
+                        'ipr_link': ['x', '', 'y']}),
+          pd.DataFrame({'name': ['b0002', 'b0003'],
+                        'go_id': ['GO:3', None],
+                        'ipr_link': ['', 'z']})]
+
+
+def write_chunks(file_name, output_format, compression=None):
+    with OutputWriter(file_name, COLUMNS, output_format,
+                      compression) as writer:
+        for chunk in CHUNKS:
+            writer.write(chunk)
+    return writer
+
+
+@pytest.mark.parametrize('file_name,output_format,compression', [
+    ('out.csv', 'csv', None), ('out.csv.gz', 'csv', 'gzip'),
+    ('out.parquet', 'parquet', 'snappy'), ('out.arrow', 'arrow', None)])
+def test_output_is_read_back_a_gene_at_a_time(tmp_path, file_name,
+                                              output_format, compression):
+    if output_format != 'csv':
+        pytest.importorskip('pyarrow')
+    file_name = str(tmp_path / file_name)
+    writer = write_chunks(file_name, output_format, compression)
+    assert writer.rows == 5
+
+    # the rows of b0002 are in two of the chunks read
+    dfs = list(whole_genes(read_output(file_name, output_format,
+                                       chunk_rows=2)))
+    genes = [g for df in dfs for g in df['name'].unique()]
+    assert genes == ['b0001', 'b0002', 'b0003']
+    df = pd.concat(dfs, ignore_index=True)
+    df = df.astype(object).where(df.notnull(), '')
+    expected = pd.concat(CHUNKS, ignore_index=True)
+    assert df.equals(expected.astype(object).where(expected.notnull(), ''))
+
+
+def test_whole_genes_keeps_genes_together():
+    chunks = [pd.DataFrame({'name': names}) for names in
+              [['a', 'b'], ['b'], ['b', 'c', 'c'], []]]
+    assert [list(df['name']) for df in whole_genes(chunks)] == \
+        [['a'], ['b', 'b', 'b'], ['c', 'c']]
@@ -0,0 +1,114 @@
+import driver
+import pandas as pd
+
+
+# reshape_data as it was before it was rewritten, one scan of the frame per
+# gene with the GO, InterPro and CDD columns joined into '|||' strings
+def merge_columns(df, column_names):
+    column_names = [c for c in column_names if c in df.columns]
+    merged_column_name = '|||'.join(column_names)
+    merged_columns = []
+    for i, row in df.iterrows():
+        for name in column_names:
+            if row[name] is None:
+                row[name] = ''
+            else:
+                row[name] = str(row[name])
+        merged_columns.append('|||'.join(row[column_names]))
+    df[merged_column_name] = merged_columns
+    df.drop(column_names, axis=1, inplace=True)
+    return(df, column_names)
+
+
+def unmerge_columns(df, column_names):
+    merged_column_name = '|||'.join(column_names)
+    new_columns = pd.DataFrame([x.split('|||') for x in df[merged_column_name]],
+                               columns=column_names)
+    df = pd.concat([df, new_columns], axis=1)
+    df.drop(merged_column_name, axis=1, inplace=True)
+    return(df)
+
+
+def baseline_reshape_data(df):
+    df = df.copy()
+    df, go_names = merge_columns(df, ['go_id', 'go_name', 'go_type'])
+    df, ipr_names = merge_columns(df, ['ipr_id', 'ipr_name'])
+    df, cdd_names = merge_columns(df, ['accession', 'cdd_name', 'e-value',
+                                       'cdd_description'])
+    genes = df['name'].unique()
+    new_rows = []
+    columns = df.columns.values
+    for gene in genes:
+        rows = df[df['name'] == gene].fillna(value='')
+        num_rows = 0
+        for column in columns:
+            num_unique_vals = len(set([x for x in rows[column]]))
+            num_rows = max(num_rows, num_unique_vals)
+        for i in range(num_rows):
+            row_values = []
+            for column in columns:
+                col_vals = rows[column].unique()
+                if i < len(col_vals):
+                    row_values.append(col_vals[i])
+                elif column == 'name':
+                    row_values.append(gene)
+                else:
+                    row_values.append('')
+            new_rows.append(row_values)
+    df = pd.DataFrame(new_rows, columns=columns)
+    df = unmerge_columns(df, go_names)
+    df = unmerge_columns(df, ipr_names)
+    df = unmerge_columns(df, cdd_names)
+    return(df)
+
+
+# Merged rows of three genes: b0001 has two GO terms, two InterPro entries and
+# two domains in every combination, b0002 has blanks inside and outside the
+# groups and a domain shared by two GO terms, b0003 has one row of blanks
+def merged_rows():
+    rows = []
+    for go in [('GO:1', 'go one', 'process'), ('GO:2', 'go two', 'function')]:
+        for ipr in [('IPR1', 'ipr one'), ('IPR2', 'ipr two')]:
+            for domain in [('cd1', 'dom1', '1e-10', 'first domain'),
+                           ('pfam2', 'dom2', '2e-5', 'second domain')]:
+                rows.append(('b0001', '1', 'E. coli', 'COG1') + go + ipr +
+                            domain)
+    rows += [('b0002', '2', 'E. coli', None, 'GO:3', 'go three', None,
+              None, None, 'cd3', 'dom3', '3e-3', None),
+             ('b0002', '2', 'E. coli', None, 'GO:4', 'go four', 'process',
+              'IPR3', None, 'cd3', 'dom3', '3e-3', None),
+             ('b0002', '2', 'E. coli', 'COG2', 'GO:3', 'go three', None,
+              'IPR3', None, None, None, None, None),
+             ('b0003', '3', None, None, None, None, None, None, None, None,
+              None, None, None)]
+    return pd.DataFrame(rows, columns=[
+        'name', 'locus_id', 'organism', 'cog_info_id', 'go_id', 'go_name',
+        'go_type', 'ipr_id', 'ipr_name', 'accession', 'cdd_name', 'e-value',
+        'cdd_description'], dtype=object)
+
+
+def test_reshape_matches_baseline():
+    df = merged_rows()
+    expected = baseline_reshape_data(df)
+    result = driver.reshape_data(df.copy())
+    # the old version moved the grouped columns to the end, and wrote
+    # missing values inside a group as 'nan' where they are blank now
+    assert list(result.columns) == list(df.columns)
+    expected = expected.astype(str).replace('nan', '')
+    pd.testing.assert_frame_equal(result[expected.columns].astype(str),
+                                  expected)
+
+
+def test_reshape_pads_genes_with_blanks():
+    result = driver.reshape_data(merged_rows())
+    assert list(result['name']) == ['b0001']*2 + ['b0002']*2 + ['b0003']
+    b0001 = result[result['name'] == 'b0001']
+    assert list(b0001['ipr_id']) == ['IPR1', 'IPR2']
+    assert list(b0001['cdd_description']) == ['first domain',
+                                              'second domain']
+    b0002 = result[result['name'] == 'b0002']
+    assert list(b0002['go_id']) == ['GO:3', 'GO:4']
+    assert list(b0002['go_type']) == ['', 'process']
+    assert list(b0002['accession']) == ['cd3', '']
+    assert list(b0002['cog_info_id']) == ['', 'COG2']
+    assert list(result.iloc[-1].drop(['name', 'locus_id'])) == ['']*11
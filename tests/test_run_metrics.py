@@ -0,0 +1,11 @@
+from run_metrics import RunMetrics
+
+
+def test_values_keep_a_window():
+    metrics = RunMetrics(window=3)
+    for value in [1, 2, 3, 10, 20]:
+        metrics.observe('rows', value)
+    assert metrics.report()['values']['rows'] == {
+        'count': 5, 'total': 36, 'mean': 7.2, 'min': 1, 'max': 20,
+        'recent_median': 10}
+    assert len(metrics.values['rows'][4]) == 3
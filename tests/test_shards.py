@@ -0,0 +1,39 @@
+import os
+import random
+import shutil
+
+import benchmark
+import shards
+
+
+# Sharded runs of a shuffled gene list, with some genes already in the
+# cache, write the same output as one run
+def test_merged_shards_match_a_single_run(stand_ins, run_driver):
+    genes = benchmark.make_genes(60)
+    random.Random(0).shuffle(genes)
+    with open('cached.txt', 'w') as f:
+        f.write('\n'.join(genes[::3]) + '\n')
+    with open('genes.txt', 'w') as f:
+        f.write('\n'.join(genes) + '\n')
+    run_driver('cached.txt', 'cached.csv', '--chunk-genes', '7')
+    shutil.copy('cache/annotation-cache.sqlite', 'cache-warm.sqlite')
+
+    driver_args = ['--chunk-genes', '7']
+    run_driver('genes.txt', 'single.csv', '--compression', 'none',
+               *driver_args)
+
+    shutil.copy('cache-warm.sqlite', 'cache/annotation-cache.sqlite')
+    count = 3
+    os.makedirs(shards.SHARD_DIRECTORY)
+    for index in range(count):
+        file_name = shards.shard_file(genes, index, count, 'csv',
+                                      driver_args=driver_args)
+        run_driver('genes.txt', file_name, '--shard',
+                   '{}/{}'.format(index + 1, count), '--format', 'csv',
+                   '--compression', 'none', *driver_args)
+    shards.merge_shards('genes.txt', 'merged.csv', count,
+                        driver_args=driver_args)
+
+    with open('single.csv') as single, open('merged.csv') as merged:
+        assert merged.read() == single.read()
+    assert [f for f in os.listdir('.') if '.partial' in f] == []